@@ -24,25 +24,185 @@ This module contains a single-server IRC bot class that can be used to
 write simpler bots.
 """
 
+import random
+import re
 import sys
-from UserDict import UserDict
+import time
 
-from irclib import SimpleIRCClient
-from irclib import nm_to_n, irc_lower, all_events
+from irclib import SimpleIRCClient, monotonic
+from irclib import nm_to_n, irc_lower, all_events, Event
 from irclib import parse_channel_modes, is_channel
 from irclib import ServerConnectionError
 
+class ReconnectPolicy:
+    """Decides when a bot reconnects and to which server.
+
+    The first retry after losing a working connection happens within
+    base seconds.  While attempts keep failing, the delay grows
+    exponentially with "decorrelated jitter" (a random delay between
+    base and three times the previous delay), up to cap seconds, so
+    that many clients don't retry in lockstep.
+
+    Failures are also recorded per server.  Servers that failed
+    demote_after times in a row are demoted: they are only tried
+    when no other server is left (see order).
+    """
+
+    def __init__(self, base=1, cap=60, demote_after=3):
+        """Constructor for ReconnectPolicy objects.
+
+        Arguments:
+
+            base -- Delay of the first retry (at most) and the
+                    minimum delay of the following ones, in seconds.
+
+            cap -- Maximum delay, in seconds.
+
+            demote_after -- Consecutive failures after which a
+                            server is demoted.
+        """
+        self.base = base
+        self.cap = cap
+        self.demote_after = demote_after
+        self.retries = 0  # Retries since the last working connection.
+        self.delay = None  # The last delay returned by next_delay.
+        self.next_attempt = None  # When that delay ends (time.time()).
+        self.servers = {}  # (server, port) -> dictionary, see state
+
+    def next_delay(self):
+        """Returns the number of seconds to wait before the next
+        retry, and counts the retry."""
+        if self.retries == 0:
+            delay = random.uniform(0, self.base)
+        else:
+            delay = random.uniform(self.base, max(self.base, self.delay) * 3)
+        self.delay = min(self.cap, delay)
+        self.retries = self.retries + 1
+        self.next_attempt = time.time() + self.delay
+        return self.delay
+
+    def reset(self):
+        """Start over with a fast first retry."""
+        self.retries = 0
+        self.delay = None
+        self.next_attempt = None
+
+    def _server(self, server):
+        """[Internal]"""
+        history = self.servers.get(server)
+        if history is None:
+            history = self.servers[server] = {"failures": 0,
+                                              "total_failures": 0,
+                                              "connects": 0,
+                                              "last_failure": None,
+                                              "last_error": None,
+                                              "last_connect": None}
+        return history
+
+    def failed(self, server, error=None):
+        """Record that connecting to server ((host, port)) failed."""
+        history = self._server(server)
+        history["failures"] = history["failures"] + 1
+        history["total_failures"] = history["total_failures"] + 1
+        history["last_failure"] = time.time()
+        history["last_error"] = error
+
+    def succeeded(self, server):
+        """Record that the bot got connected to server ((host, port)).
+
+        Also resets the backoff.
+        """
+        history = self._server(server)
+        history["failures"] = 0
+        history["connects"] = history["connects"] + 1
+        history["last_connect"] = time.time()
+        self.reset()
+
+    def is_demoted(self, server):
+        """Returns true if server ((host, port)) failed too often in a row."""
+        history = self.servers.get(server)
+        return history is not None and history["failures"] >= self.demote_after
+
+    def order(self, server_list):
+        """Returns server_list (a list of (host, port, ...) tuples)
+        with demoted servers moved to the end, those that failed
+        most last."""
+        def rank(server):
+            server = (server[0], server[1])
+            if self.is_demoted(server):
+                return self.servers[server]["failures"]
+            return 0
+        return sorted(server_list, key=rank)
+
+    def state(self):
+        """Returns a dictionary describing the reconnect state.
+
+        The keys are retries (failed attempts since the last working
+        connection), delay and next_attempt (the current delay and
+        when it ends, as returned by time.time(); both None if no
+        retry is pending), demoted (a list of demoted servers) and
+        servers, which maps each (host, port) tried so far to a
+        dictionary with the keys failures (in a row), total_failures,
+        connects, last_failure, last_error and last_connect.
+        """
+        servers = {}
+        for server, history in self.servers.items():
+            servers[server] = history.copy()
+        return {"retries": self.retries,
+                "delay": self.delay,
+                "next_attempt": self.next_attempt,
+                "demoted": [s for s in self.servers.keys() if self.is_demoted(s)],
+                "servers": servers}
+
+
+# QUIT reason of a user lost in a netsplit: the two servers.
+_netsplit_reason = re.compile(r"^([\w-]+(?:\.[\w-]+)+) ([\w-]+(?:\.[\w-]+)+)$")
+
 class SingleServerIRCBot(SimpleIRCClient):
     """A single-server IRC bot class.
 
-    The bot tries to reconnect if it is disconnected.
+    The bot tries to reconnect if it is disconnected.  When and where
+    to is decided by self.reconnect_policy (see ReconnectPolicy); if
+    it is None, the bot doesn't reconnect.
 
     The bot keeps track of the channels it has joined, the other
     clients that are present in the channels and which of those that
     have operator or voice modes.  The "database" is kept in the
-    self.channels attribute, which is an IRCDict of Channels.
+    self.channels attribute, which is an IRCDict of Channels.  The
+    self.user_channels attribute is an IRCDict mapping the nicks seen
+    in the channels to the set of (lowercased) names of the channels
+    they are in; NICK and QUIT only touch those channels.
+
+    QUITs with a reason like "hub.example.net leaf.example.net" are
+    taken as a netsplit.  They are not dispatched one by one; instead,
+    once no more of them have arrived for netsplit_delay seconds, the
+    users are removed from the channels at once and a single
+    "netsplit" event is generated, with the two servers as source and
+    target and the list of nicks as arguments.  When users of a
+    netsplit join again within netsplit_memory seconds, their JOINs
+    are batched the same way into a "netjoin" event.
+
+    With parallel_connects above 1, the bot races connections to
+    several servers instead of trying one server per
+    reconnection_interval.  The attempts start connect_stagger
+    seconds apart, over both IPv6 and IPv4.  The first connection to
+    be welcomed by its server becomes self.connection; the others are
+    closed.  Until then, events of the attempts (other than
+    disconnects) are handled as usual, but with a connection object
+    that may not be self.connection.  How long each server took to
+    welcome the bot is kept in self.server_latency and decides which
+    servers are tried first the next time.
     """
-    def __init__(self, server_list, nickname, realname, reconnection_interval=60):
+    # Seconds without QUITs (JOINs) after which a netsplit (netjoin)
+    # batch is done.
+    netsplit_delay = 2
+
+    # Seconds after a netsplit in which JOINs of its users are taken as
+    # a netjoin.
+    netsplit_memory = 1800
+
+    def __init__(self, server_list, nickname, realname, reconnection_interval=60,
+                 parallel_connects=1, connect_stagger=0.25, reconnect_policy=None):
         """Constructor for SingleServerIRCBot objects.
 
         Arguments:
@@ -55,8 +215,21 @@ class SingleServerIRCBot(SimpleIRCClient):
 
             realname -- The bot's realname.
 
-            reconnection_interval -- How long the bot should wait
-                                     before trying to reconnect.
+            reconnection_interval -- The longest the bot should wait
+                                     before trying to reconnect.  Also
+                                     the connect timeout.  0 means
+                                     not to reconnect, unless a
+                                     reconnect_policy is given.
+
+            parallel_connects -- How many servers to race when
+                                 connecting (see above).
+
+            connect_stagger -- Seconds between the starts of two
+                               racing connection attempts.
+
+            reconnect_policy -- A ReconnectPolicy, or None.  The
+                                default backs off from 1 second up
+                                to reconnection_interval.
 
             dcc_connections -- A list of initiated/accepted DCC
             connections.
@@ -64,44 +237,210 @@ class SingleServerIRCBot(SimpleIRCClient):
 
         SimpleIRCClient.__init__(self)
         self.channels = IRCDict()
+        self.user_channels = IRCDict()
         self.server_list = server_list
+        reconnect = 1
         if not reconnection_interval or reconnection_interval < 0:
             reconnection_interval = 2**31
+            reconnect = 0
         self.reconnection_interval = reconnection_interval
+        if reconnect_policy is None and reconnect:
+            reconnect_policy = ReconnectPolicy(min(1, reconnection_interval),
+                                               reconnection_interval)
+        self.reconnect_policy = reconnect_policy  # None: don't reconnect.
+        self._welcomed = 0
 
         self._nickname = nickname
         self._realname = realname
-        for i in ["disconnect", "join", "kick", "mode",
-                  "namreply", "nick", "part", "quit"]:
+        self._checker = None
+        self.parallel_connects = parallel_connects
+        self.connect_stagger = connect_stagger
+        self.server_latency = {}  # (server, port) -> seconds, None if it failed
+        self._attempts = {}  # racing ServerConnection -> ((server, port), start time)
+        self._attempt_timers = []
+        self._closing = {}  # attempts being closed by _end_race
+        self._unfinished = {}  # (server, port) -> attempts not failed yet
+        self._splits = {}  # (server, server) -> [nicks, last QUIT, timer]
+        self._rejoins = {}  # (server, server) -> [[(nick, channel)], last JOIN, timer]
+        self._split_users = IRCDict()  # nick -> ((server, server), time of split)
+        for i in ["connect_failed", "disconnect", "endofnames", "join", "kick",
+                  "mode", "namreply", "nick", "part", "quit", "welcome"]:
             self.connection.add_global_handler(i,
                                                getattr(self, "_on_" + i),
                                                -10)
+        # Before the on_* methods, so batched events reach no one.
+        self.connection.add_global_handler("quit", self._netsplit_quit, -20)
+        self.connection.add_global_handler("join", self._netsplit_join, -20)
     def _connected_checker(self):
         """[Internal]"""
-        if not self.connection.is_connected():
-            self.connection.execute_delayed(self.reconnection_interval,
-                                            self._connected_checker)
+        self._checker = None
+        if not self.connection.is_connected() \
+               and not self.connection.is_connecting() and not self._attempts:
             self.jump_server()
 
+    def _schedule_connected_checker(self):
+        """[Internal] (Re)start the timer of _connected_checker, with
+        the next delay of the reconnect policy."""
+        if self._checker is not None:
+            self._checker.cancel()
+            self._checker = None
+        if self.reconnect_policy is None:
+            return
+        self._checker = self.connection.execute_delayed(self.reconnect_policy.next_delay(),
+                                                        self._connected_checker)
+
     def _connect(self):
         """[Internal]"""
+        if self.parallel_connects > 1:
+            self._race()
+            return
+        self._start_attempt(self.connection, self._ordered_servers()[0])
+
+    def _ordered_servers(self):
+        """[Internal] Returns server_list in the order of the reconnect
+        policy."""
+        if self.reconnect_policy is None:
+            return list(self.server_list)
+        return self.reconnect_policy.order(self.server_list)
+
+    def _start_attempt(self, connection, server, ipv6=False):
+        """[Internal] Start connecting connection to a server_list entry."""
         password = None
-        if len(self.server_list[0]) > 2:
-            password = self.server_list[0][2]
+        if len(server) > 2:
+            password = server[2]
         try:
-            self.connect(self.server_list[0][0],
-                         self.server_list[0][1],
-                         self._nickname,
-                         password,
-                         ircname=self._realname)
+            connection.connect(server[0],
+                               server[1],
+                               self._nickname,
+                               password,
+                               ircname=self._realname,
+                               ipv6=ipv6,
+                               nonblocking=True,
+                               timeout=self.reconnection_interval)
         except ServerConnectionError:
             pass
 
+    def _race(self):
+        """[Internal] Race connections to the best servers."""
+        self._end_race()
+        def rank(server):
+            if self.reconnect_policy is not None \
+                   and self.reconnect_policy.is_demoted((server[0], server[1])):
+                return (3, 0)
+            latency = self.server_latency.get((server[0], server[1]), -1)
+            if latency is None:  # Failed last time.
+                return (2, 0)
+            if latency < 0:  # Not tried yet.
+                return (1, 0)
+            return (0, latency)
+        servers = sorted(self._ordered_servers(), key=rank)[:self.parallel_connects]
+        self.ircobj.add_global_handler("all_events", self._race_guard, -50)
+        delay = 0
+        for server in servers:
+            self._unfinished[(server[0], server[1])] = 2
+            for ipv6 in (True, False):
+                self._attempt_timers.append(
+                    self.connection.execute_delayed(delay, self._start_race_attempt,
+                                                    (server, ipv6)))
+                delay = delay + self.connect_stagger
+
+    def _start_race_attempt(self, server, ipv6):
+        """[Internal]"""
+        if self.connection in self._attempts or self.connection.is_connected():
+            c = self.ircobj.server()
+        else:
+            c = self.connection
+        self._attempts[c] = ((server[0], server[1]), monotonic())
+        self._start_attempt(c, server, ipv6)
+
+    def _race_guard(self, c, e):
+        """[Internal] Pick the winner of a connection race."""
+        if c in self._closing:
+            return "NO MORE"
+        if c not in self._attempts:
+            return
+        eventtype = e.eventtype()
+        if eventtype == "welcome":
+            server, started = self._attempts.pop(c)
+            self.server_latency[server] = monotonic() - started
+            if c is not self.connection:
+                old = self.connection
+                self.connection = c
+                self._adopt_settings(old, c)
+                if old not in self._attempts:
+                    old.close()
+            self._end_race()
+        elif eventtype in ("disconnect", "connect_failed"):
+            server = self._attempts.pop(c)[0]
+            self._unfinished[server] = self._unfinished[server] - 1
+            if not self._unfinished[server]:
+                self.server_latency[server] = None
+                if self.reconnect_policy is not None:
+                    self.reconnect_policy.failed(server, e.arguments() and e.arguments()[0])
+            if c is not self.connection:
+                self.ircobj._remove_connection(c)
+            if not self._attempts \
+                   and not [t for t in self._attempt_timers if not t.cancelled]:
+                # Every attempt failed.
+                self._end_race()
+                self._schedule_connected_checker()
+            return "NO MORE"
+
+    def _end_race(self):
+        """[Internal] Stop racing and close the remaining attempts."""
+        for timer in self._attempt_timers:
+            timer.cancel()
+        self._attempt_timers = []
+        self._unfinished = {}
+        self._closing, self._attempts = self._attempts, {}
+        for c in self._closing.keys():
+            if c is self.connection:
+                c.disconnect()
+            else:
+                c.close()
+        self._closing = {}
+        self.ircobj.remove_global_handler("all_events", self._race_guard)
+
+    def _adopt_settings(self, old, new):
+        """[Internal] Carry settings over to the connection that
+        replaces self.connection."""
+        fc = old.flood_control
+        if fc is not None:
+            new.set_rate_limit(fc.lines.rate, fc.bytes.rate,
+                               fc.lines.burst, fc.bytes.burst)
+
+    def _on_connect_failed(self, c, e):
+        """[Internal]"""
+        if self.reconnect_policy is not None:
+            self.reconnect_policy.failed((c.server, c.port), e.arguments()[0])
+        self._schedule_connected_checker()
+
     def _on_disconnect(self, c, e):
         """[Internal]"""
         self.channels = IRCDict()
-        self.connection.execute_delayed(self.reconnection_interval,
-                                        self._connected_checker)
+        self.user_channels = IRCDict()
+        for batch in self._splits.values() + self._rejoins.values():
+            batch[2].cancel()
+        self._splits = {}
+        self._rejoins = {}
+        self._split_users = IRCDict()
+        welcomed, self._welcomed = self._welcomed, 0
+        if self.reconnect_policy is None:
+            # Don't reconnect.
+            return
+        if welcomed:
+            # Lost a working connection: retry quickly.
+            self.reconnect_policy.reset()
+        else:
+            # The server hung up on us before we were registered.
+            self.reconnect_policy.failed((c.server, c.port), e.arguments()[0])
+        self._schedule_connected_checker()
+
+    def _on_welcome(self, c, e):
+        """[Internal]"""
+        self._welcomed = 1
+        if self.reconnect_policy is not None:
+            self.reconnect_policy.succeeded((c.server, c.port))
 
     def _on_join(self, c, e):
         """[Internal]"""
@@ -109,7 +448,7 @@ class SingleServerIRCBot(SimpleIRCClient):
         nick = nm_to_n(e.source())
         if nick == c.get_nickname():
             self.channels[ch] = Channel()
-        self.channels[ch].add_user(nick)
+        self._add_user(ch, nick)
 
     def _on_kick(self, c, e):
         """[Internal]"""
@@ -117,22 +456,27 @@ class SingleServerIRCBot(SimpleIRCClient):
         channel = e.target()
 
         if nick == c.get_nickname():
-            del self.channels[channel]
+            self._remove_channel(channel)
         else:
-            self.channels[channel].remove_user(nick)
+            self._remove_user(channel, nick)
 
     def _on_mode(self, c, e):
         """[Internal]"""
-        modes = parse_channel_modes(" ".join(e.arguments()))
         t = e.target()
         if is_channel(t):
+            # The prefix modes take a nick; the list modes (type A and
+            # B of CHANMODES, like a +q quiet list) take a mask.
+            member_modes = "".join(c.get_prefixes().values())
+            list_modes = "".join(c.isupport.get("CHANMODES", "").split(",")[:2])
+            modes = parse_channel_modes(" ".join(e.arguments()),
+                                        member_modes + list_modes)
             ch = self.channels[t]
             for mode in modes:
                 if mode[0] == "+":
                     f = ch.set_mode
                 else:
                     f = ch.clear_mode
-                f(mode[1], mode[2])
+                f(mode[1], mode[2], member_modes)
         else:
             # Mode on self... XXX
             pass
@@ -147,22 +491,33 @@ class SingleServerIRCBot(SimpleIRCClient):
         # e.arguments()[2] == nick list
 
         ch = e.arguments()[1]
-        for nick in e.arguments()[2].split():
-            if nick[0] == "@":
-                nick = nick[1:]
-                self.channels[ch].set_mode("o", nick)
-            elif nick[0] == "+":
-                nick = nick[1:]
-                self.channels[ch].set_mode("v", nick)
-            self.channels[ch].add_user(nick)
+        if ch in self.channels:
+            self.channels[ch].add_names(e.arguments()[2], c.get_prefixes())
+
+    def _on_endofnames(self, c, e):
+        """[Internal]"""
+        ch = e.arguments()[0]
+        if ch not in self.channels:
+            return
+        key = _canonical(ch)
+        user_channels = self.user_channels
+        for nick in self.channels[ch].end_names():
+            channels = user_channels.get(nick)
+            if channels is None:
+                channels = user_channels[nick] = set()
+            channels.add(key)
 
     def _on_nick(self, c, e):
         """[Internal]"""
         before = nm_to_n(e.source())
         after = e.target()
-        for ch in self.channels.values():
-            if ch.has_user(before):
-                ch.change_nick(before, after)
+        channels = self.user_channels.get(before)
+        if channels is None:
+            return
+        for ch in channels:
+            self.channels[ch].change_nick(before, after)
+        del self.user_channels[before]
+        self.user_channels[after] = channels
 
     def _on_part(self, c, e):
         """[Internal]"""
@@ -170,16 +525,138 @@ class SingleServerIRCBot(SimpleIRCClient):
         channel = e.target()
 
         if nick == c.get_nickname():
-            del self.channels[channel]
+            self._remove_channel(channel)
         else:
-            self.channels[channel].remove_user(nick)
+            self._remove_user(channel, nick)
 
     def _on_quit(self, c, e):
         """[Internal]"""
+        self._remove_user_everywhere(nm_to_n(e.source()))
+
+    def _remove_user_everywhere(self, nick):
+        """[Internal] Remove a user from all channels."""
+        channels = self.user_channels.get(nick)
+        if channels is None:
+            return
+        for ch in channels:
+            self.channels[ch].remove_user(nick)
+        del self.user_channels[nick]
+
+    def _netsplit_quit(self, c, e):
+        """[Internal] Batch the QUITs of a netsplit."""
+        m = _netsplit_reason.match(e.arguments() and e.arguments()[0] or "")
+        if not m:
+            return
         nick = nm_to_n(e.source())
-        for ch in self.channels.values():
-            if ch.has_user(nick):
-                ch.remove_user(nick)
+        if nick not in self.user_channels:
+            return
+        servers = m.groups()
+        batch = self._add_to_batch(c, self._splits, servers, self._flush_netsplit)
+        batch[0].append(nick)
+        self._split_users[nick] = (servers, monotonic())
+        return "NO MORE"
+
+    def _netsplit_join(self, c, e):
+        """[Internal] Batch the JOINs of users coming back from a
+        netsplit."""
+        nick = nm_to_n(e.source())
+        split = self._split_users.get(nick)
+        if split is None:
+            return
+        servers, when = split
+        if monotonic() - when > self.netsplit_memory or servers in self._splits:
+            # Too old, or the split is not even over.
+            del self._split_users[nick]
+            if servers in self._splits:
+                # The user did quit, so leave the batch now: its flush
+                # would remove the user from the channel joined here.
+                nicks = self._splits[servers][0]
+                nicks[:] = [n for n in nicks if irc_lower(n) != irc_lower(nick)]
+                self._remove_user_everywhere(nick)
+            return
+        batch = self._add_to_batch(c, self._rejoins, servers, self._flush_netjoin)
+        batch[0].append((nick, e.target()))
+        return "NO MORE"
+
+    def _add_to_batch(self, c, batches, servers, flush):
+        """[Internal] Returns the batch of servers, started if needed."""
+        batch = batches.get(servers)
+        if batch is None:
+            timer = c.execute_delayed(self.netsplit_delay, flush, (c, servers))
+            batch = batches[servers] = [[], monotonic(), timer]
+        else:
+            batch[1] = monotonic()
+        return batch
+
+    def _batch_done(self, c, batches, servers, flush):
+        """[Internal] Returns the finished batch of servers, or None if
+        it got events less than netsplit_delay seconds ago."""
+        batch = batches[servers]
+        wait = batch[1] + self.netsplit_delay - monotonic()
+        if wait > 0:
+            batch[2] = c.execute_delayed(wait, flush, (c, servers))
+            return None
+        del batches[servers]
+        return batch
+
+    def _flush_netsplit(self, c, servers):
+        """[Internal]"""
+        batch = self._batch_done(c, self._splits, servers, self._flush_netsplit)
+        if batch is None:
+            return
+        nicks = batch[0]
+        for nick in nicks:
+            self._remove_user_everywhere(nick)
+        # Forget the users of old netsplits that never came back.
+        oldest = monotonic() - self.netsplit_memory
+        for nick, (servers_, when) in self._split_users.items():
+            if when < oldest:
+                del self._split_users[nick]
+        if nicks:
+            # Empty if all of them came back before the split was over.
+            c._handle_event(Event("netsplit", servers[0], servers[1], nicks))
+
+    def _flush_netjoin(self, c, servers):
+        """[Internal]"""
+        batch = self._batch_done(c, self._rejoins, servers, self._flush_netjoin)
+        if batch is None:
+            return
+        nicks = []
+        for nick, channel in batch[0]:
+            if nick in self._split_users:
+                del self._split_users[nick]
+                nicks.append(nick)
+            if channel in self.channels:
+                self._add_user(channel, nick)
+        c._handle_event(Event("netjoin", servers[0], servers[1], nicks))
+
+    def _add_user(self, channel, nick):
+        """[Internal] Add a user to a channel and to user_channels."""
+        self.channels[channel].add_user(nick)
+        channels = self.user_channels.get(nick)
+        if channels is None:
+            channels = self.user_channels[nick] = set()
+        channels.add(_canonical(channel))
+
+    def _remove_user(self, channel, nick):
+        """[Internal] Remove a user from a channel and from
+        user_channels."""
+        self.channels[channel].remove_user(nick)
+        channels = self.user_channels.get(nick)
+        if channels is not None:
+            channels.discard(_canonical(channel))
+            if not channels:
+                del self.user_channels[nick]
+
+    def _remove_channel(self, channel):
+        """[Internal] Forget a channel the bot has left."""
+        for nick in self.channels[channel].users():
+            channels = self.user_channels.get(nick)
+            if channels is not None:
+                channels.discard(_canonical(channel))
+                if not channels:
+                    del self.user_channels[nick]
+        del self.channels[channel]
 
     def die(self, msg="Bye, cruel world!"):
         """Let the bot die.
@@ -190,6 +667,7 @@ class SingleServerIRCBot(SimpleIRCClient):
         """
 
         self.connection.disconnect(msg)
+        self.stop_dcc_shards(msg)
         sys.exit(0)
 
     def disconnect(self, msg="I'll be back!"):
@@ -218,6 +696,7 @@ class SingleServerIRCBot(SimpleIRCClient):
         """
         if self.connection.is_connected():
             self.connection.disconnect(msg)
+        self._end_race()
 
         self.server_list.append(self.server_list.pop(0))
         self._connect()
@@ -225,8 +704,9 @@ class SingleServerIRCBot(SimpleIRCClient):
     def on_ctcp(self, c, e):
         """Default handler for ctcp events.
 
-        Replies to VERSION and PING requests and relays DCC requests
-        to the on_dccchat method.
+        Replies to VERSION and PING requests, relays DCC CHAT requests
+        to the on_dccchat method and answers DCC RESUME requests for
+        files offered with dcc_send.
         """
         if e.arguments()[0] == "VERSION":
             c.ctcp_reply(nm_to_n(e.source()),
@@ -235,8 +715,17 @@ class SingleServerIRCBot(SimpleIRCClient):
             if len(e.arguments()) > 1:
                 c.ctcp_reply(nm_to_n(e.source()),
                              "PING " + e.arguments()[1])
-        elif e.arguments()[0] == "DCC" and e.arguments()[1].split(" ", 1)[0] == "CHAT":
-            self.on_dccchat(c, e)
+        elif e.arguments()[0] == "DCC" and len(e.arguments()) > 1:
+            args = e.arguments()[1].split()
+            if args[:1] == ["CHAT"]:
+                self.on_dccchat(c, e)
+            elif args[:1] == ["RESUME"] and len(args) >= 4:
+                try:
+                    port, position = int(args[-2]), long(args[-1])
+                except ValueError:
+                    return
+                self.dcc_resume(nm_to_n(e.source()), " ".join(args[1:-2]),
+                                port, position)
 
     def on_dccchat(self, c, e):
         pass
@@ -247,6 +736,23 @@ class SingleServerIRCBot(SimpleIRCClient):
         SimpleIRCClient.start(self)
 
 
+_canonical_keys = {}
+_canonical_keys_limit = 2**16
+
+def _canonical(key):
+    """[Internal] Returns irc_lower(key), interned and cached for keys
+    seen before."""
+    try:
+        return _canonical_keys[key]
+    except KeyError:
+        if len(_canonical_keys) >= _canonical_keys_limit:
+            _canonical_keys.clear()
+        ck = irc_lower(key)
+        if type(ck) is str:
+            ck = intern(ck)
+        _canonical_keys[key] = ck
+        return ck
+
 class IRCDict:
     """A dictionary suitable for storing IRC-related things.
 
@@ -254,116 +760,203 @@ class IRCDict:
     irc_lower(a) == irc_lower(b)
 
     Otherwise, it should behave exactly as a normal dictionary.
+
+    Items are stored once, under the lowercased key, and the key as
+    given is kept only where it differs from that.  Lowercased keys
+    are interned and cached, so a nick seen before is not lowercased
+    again, and all IRCDicts share one copy of it.
     """
 
     def __init__(self, dict=None):
-        self.data = {}
-        self.canon_keys = {}  # Canonical keys
+        self._items = {}  # Canonical key -> value
+        self._keys = {}  # Canonical key -> key, where they differ
         if dict is not None:
             self.update(dict)
     def __repr__(self):
-        return repr(self.data)
-    def __cmp__(self, dict):
-        if isinstance(dict, IRCDict):
-            return cmp(self.data, dict.data)
-        else:
-            return cmp(self.data, dict)
+        return repr(dict(self.items()))
+    def __cmp__(self, other):
+        if isinstance(other, IRCDict):
+            other = dict(other.items())
+        return cmp(dict(self.items()), other)
     def __len__(self):
-        return len(self.data)
+        return len(self._items)
     def __getitem__(self, key):
-        return self.data[self.canon_keys[irc_lower(key)]]
+        return self._items[_canonical(key)]
     def __setitem__(self, key, item):
-        if key in self:
-            del self[key]
-        self.data[key] = item
-        self.canon_keys[irc_lower(key)] = key
+        ck = _canonical(key)
+        self._items[ck] = item
+        if ck == key:
+            if ck in self._keys:
+                del self._keys[ck]
+        else:
+            self._keys[ck] = key
     def __delitem__(self, key):
-        ck = irc_lower(key)
-        del self.data[self.canon_keys[ck]]
-        del self.canon_keys[ck]
+        ck = _canonical(key)
+        del self._items[ck]
+        if ck in self._keys:
+            del self._keys[ck]
     def __iter__(self):
-        return iter(self.data)
+        keys = self._keys
+        for ck in self._items:
+            yield keys.get(ck, ck)
     def __contains__(self, key):
-        return self.has_key(key)
+        return _canonical(key) in self._items
     def clear(self):
-        self.data.clear()
-        self.canon_keys.clear()
+        self._items.clear()
+        self._keys.clear()
     def copy(self):
-        if self.__class__ is UserDict:
-            return UserDict(self.data)
-        import copy
-        return copy.copy(self)
+        return IRCDict(self)
     def keys(self):
-        return self.data.keys()
+        keys = self._keys
+        return [keys.get(ck, ck) for ck in self._items]
     def items(self):
-        return self.data.items()
+        keys = self._keys
+        return [(keys.get(ck, ck), v) for ck, v in self._items.iteritems()]
     def values(self):
-        return self.data.values()
+        return self._items.values()
     def has_key(self, key):
-        return irc_lower(key) in self.canon_keys
+        return _canonical(key) in self._items
     def update(self, dict):
-        for k, v in dict.items():
-            self.data[k] = v
+        """Update from a dictionary or a list of (key, value) pairs."""
+        if hasattr(dict, "items"):
+            dict = dict.items()
+        items = self._items
+        keys = self._keys
+        for k, v in dict:
+            ck = _canonical(k)
+            items[ck] = v
+            if ck != k:
+                keys[ck] = k
+            elif ck in keys:
+                del keys[ck]
     def get(self, key, failobj=None):
-        return self.data.get(key, failobj)
-
+        return self._items.get(_canonical(key), failobj)
+    def original_key(self, key):
+        """Returns the key as it was stored for key."""
+        ck = _canonical(key)
+        if ck not in self._items:
+            raise KeyError, key
+        return self._keys.get(ck, ck)
+
+
+# Channel member flags, by mode character.  Other prefix modes a
+# server announces get the next free bits.
+_member_flags = {"o": 1, "v": 2, "h": 4, "a": 8, "q": 16}
+
+def _member_flag(mode):
+    """[Internal] Returns the flag of a member mode."""
+    flag = _member_flags.get(mode)
+    if flag is None:
+        flag = _member_flags[mode] = 1 << len(_member_flags)
+    return flag
 
 class Channel:
     """A class for keeping information about an IRC channel.
 
+    Each member is stored once, with its operator, voice and other
+    prefix modes as bits of a flags value.
+
     This class can be improved a lot.
     """
 
     def __init__(self):
-        self.userdict = IRCDict()
-        self.operdict = IRCDict()
-        self.voiceddict = IRCDict()
+        self.members = IRCDict()  # Nick -> flags
         self.modes = {}
+        self._names = []  # (nick, flags) of NAMES replies, see add_names
 
     def users(self):
         """Returns an unsorted list of the channel's users."""
-        return self.userdict.keys()
+        return self.members.keys()
 
     def opers(self):
         """Returns an unsorted list of the channel's operators."""
-        return self.operdict.keys()
+        return self._members_with("o")
 
     def voiced(self):
         """Returns an unsorted list of the persons that have voice
         mode set in the channel."""
-        return self.voiceddict.keys()
+        return self._members_with("v")
+
+    def _members_with(self, mode):
+        """[Internal]"""
+        flag = _member_flags[mode]
+        return [nick for nick, flags in self.members.items() if flags & flag]
 
     def has_user(self, nick):
         """Check whether the channel has a user."""
-        return nick in self.userdict
+        return nick in self.members
+
+    def user_modes(self, nick):
+        """Returns the prefix modes (e.g. "ov") a user has in the
+        channel."""
+        flags = self.members.get(nick, 0)
+        return "".join([mode for mode, flag in _member_flags.items() if flags & flag])
+
+    def add_names(self, names, prefixes):
+        """Take in a NAMES reply (RPL_NAMREPLY) for the channel.
+
+        The nicks are parsed in one pass, but only become members when
+        end_names is called at the end of the NAMES list.
+
+        Arguments:
+
+            names -- The space separated nick list.  A nick may have
+                     several prefixes (multi-prefix) and may be given
+                     as nick!user@host (userhost-in-names).
+
+            prefixes -- A dictionary mapping prefix characters to mode
+                        characters, see ServerConnection.get_prefixes.
+        """
+        flags = {}
+        for char, mode in prefixes.items():
+            flags[char] = _member_flag(mode)
+        append = self._names.append
+        for name in names.split():
+            f = 0
+            i = 0
+            while i < len(name) and name[i] in flags:
+                f = f | flags[name[i]]
+                i = i + 1
+            if i:
+                name = name[i:]
+            if "!" in name:
+                name = name[:name.index("!")]
+            if name:
+                append((name, f))
+
+    def end_names(self):
+        """Add the nicks taken in by add_names since the last call to
+        the members, in one go.
+
+        Returns the list of nicks.
+        """
+        names = self._names
+        self._names = []
+        self.members.update(names)
+        return [nick for nick, flags in names]
 
     def is_oper(self, nick):
         """Check whether a user has operator status in the channel."""
-        return nick in self.operdict
+        return bool(self.members.get(nick, 0) & _member_flags["o"])
 
     def is_voiced(self, nick):
         """Check whether a user has voice mode set in the channel."""
-        return nick in self.voiceddict
+        return bool(self.members.get(nick, 0) & _member_flags["v"])
 
     def add_user(self, nick):
-        self.userdict[nick] = 1
+        if nick not in self.members:
+            self.members[nick] = 0
 
     def remove_user(self, nick):
-        for d in self.userdict, self.operdict, self.voiceddict:
-            if nick in d:
-                del d[nick]
+        if nick in self.members:
+            del self.members[nick]
 
     def change_nick(self, before, after):
-        self.userdict[after] = 1
-        del self.userdict[before]
-        if before in self.operdict:
-            self.operdict[after] = 1
-            del self.operdict[before]
-        if before in self.voiceddict:
-            self.voiceddict[after] = 1
-            del self.voiceddict[before]
-
-    def set_mode(self, mode, value=None):
+        flags = self.members[before]
+        del self.members[before]
+        self.members[after] = flags
+
+    def set_mode(self, mode, value=None, member_modes="ov"):
         """Set mode on the channel.
 
         Arguments:
@@ -371,15 +964,22 @@ class Channel:
             mode -- The mode (a single-character string).
 
             value -- Value
+
+            member_modes -- The modes given to channel members, whose
+                            value is a nick (the modes of the server's
+                            PREFIX, see ServerConnection.get_prefixes).
         """
-        if mode == "o":
-            self.operdict[value] = 1
-        elif mode == "v":
-            self.voiceddict[value] = 1
+        if mode in member_modes:
+            # Only members get flags; anyone else would be missing from
+            # the channel index of users.
+            if value is not None and value in self.members:
+                # Keep the nick as the user joined.
+                value = self.members.original_key(value)
+                self.members[value] = self.members[value] | _member_flag(mode)
         else:
             self.modes[mode] = value
 
-    def clear_mode(self, mode, value=None):
+    def clear_mode(self, mode, value=None, member_modes="ov"):
         """Clear mode on the channel.
 
         Arguments:
@@ -387,16 +987,18 @@ class Channel:
             mode -- The mode (a single-character string).
 
             value -- Value
+
+            member_modes -- See set_mode.
         """
-        try:
-            if mode == "o":
-                del self.operdict[value]
-            elif mode == "v":
-                del self.voiceddict[value]
-            else:
+        if mode in member_modes:
+            if value is not None and value in self.members:
+                value = self.members.original_key(value)
+                self.members[value] = self.members[value] & ~_member_flag(mode)
+        else:
+            try:
                 del self.modes[mode]
-        except KeyError:
-            pass
+            except KeyError:
+                pass
 
     def has_mode(self, mode):
         return mode in self.modes
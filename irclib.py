@@ -39,8 +39,9 @@ The main features of the IRC client framework are:
   * Messages from an IRC server triggers events, which can be caught
     by event handlers.
   * Reading from and writing to IRC server sockets are normally done
-    by an internal select() loop, but the select()ing may be done by
-    an external main loop.
+    by an internal reactor loop (epoll, poll or select, whichever is
+    the best available), but the polling may be done by an external
+    main loop.
   * Functions can be registered to execute at specified times by the
     event-loop.
   * Decodes CTCP tagging correctly (hopefully); I haven't seen any
@@ -52,8 +53,6 @@ The main features of the IRC client framework are:
 Current limitations:
 
   * The IRC protocol shines through the abstraction a bit too much.
-  * Data is not written asynchronously to the server, i.e. the write()
-    may block if the TCP buffers are stuffed.
   * There are no support for DCC file transfers.
   * The author haven't even read RFC 2810, 2811, 2812 and 2813.
   * Like most projects, documentation is lacking...
@@ -62,14 +61,26 @@ Current limitations:
 """
 
 import bisect
+import collections
+import errno
+import heapq
+import itertools
+import os
 import re
 import select
 import socket
 import string
+import struct
 import sys
+import threading
 import time
 import types
 
+try:
+    import ssl as _tls
+except ImportError:
+    _tls = None
+
 VERSION = 0, 4, 8
 DEBUG = 0
 
@@ -79,7 +90,6 @@ DEBUG = 0
 # (maybe) color parser convenience functions
 # documentation (including all event types)
 # (maybe) add awareness of different types of ircds
-# send data asynchronously to the server (and DCC connections)
 # (maybe) automatically close unused, passive DCC connections after a while
 
 # NOTES
@@ -93,6 +103,280 @@ class IRCError(Exception):
     pass
 
 
+class Reactor:
+    """Base class for reactor backends.
+
+    A reactor keeps track of the sockets an IRC object is interested
+    in and waits for incoming data on them, and for writability on
+    the sockets that have output pending.  Sockets are registered and
+    unregistered incrementally (see IRC.__init__), so a tick does not
+    have to rebuild the socket set.
+
+    Subclasses must override _add, _remove, _modify and poll.
+    """
+
+    def __init__(self):
+        self.sockets = {}  # fd -> socket object
+        self.fds = {}      # socket object -> fd
+        self.writing = {}  # fds watched for writability -> 1
+
+    def __len__(self):
+        return len(self.sockets)
+
+    def register(self, sock):
+        """Start watching a socket for incoming data."""
+        if sock is None or sock in self.fds:
+            return
+        fd = sock.fileno()
+        self.sockets[fd] = sock
+        self.fds[sock] = fd
+        self._add(fd)
+
+    def unregister(self, sock):
+        """Stop watching a socket.
+
+        Unknown sockets are ignored, so it is safe to call this more
+        than once for the same socket.
+        """
+        fd = self.fds.pop(sock, None)
+        if fd is None:
+            return
+        del self.sockets[fd]
+        self.writing.pop(fd, None)
+        self._remove(fd)
+
+    def watch_write(self, sock, flag):
+        """Start (flag is true) or stop watching a registered socket
+        for writability."""
+        fd = self.fds.get(sock)
+        if fd is None or (fd in self.writing) == bool(flag):
+            return
+        if flag:
+            self.writing[fd] = 1
+        else:
+            del self.writing[fd]
+        self._modify(fd, flag)
+
+    def poll(self, timeout):
+        """Wait for incoming data or writability.
+
+        Arguments:
+
+            timeout -- How long to wait (in seconds) if no socket is
+                       ready.  None means wait until one is.
+
+        Returns a tuple of two lists: the readable and the writable
+        socket objects.
+        """
+        raise IRCError, "Not overridden"
+
+    def _add(self, fd):
+        raise IRCError, "Not overridden"
+
+    def _remove(self, fd):
+        raise IRCError, "Not overridden"
+
+    def _modify(self, fd, writable):
+        raise IRCError, "Not overridden"
+
+
+class SelectReactor(Reactor):
+    """Reactor backend using select.select().
+
+    This is the portable fallback.  It can not handle descriptors
+    above FD_SETSIZE.
+    """
+
+    def _add(self, fd):
+        pass
+
+    def _remove(self, fd):
+        pass
+
+    def _modify(self, fd, writable):
+        pass
+
+    def poll(self, timeout):
+        if not self.sockets:
+            # Nothing to wait for; don't spin if asked to block.
+            if timeout is None:
+                timeout = 1.0
+            if timeout:
+                time.sleep(timeout)
+            return [], []
+        writers = [self.sockets[fd] for fd in self.writing]
+        try:
+            (i, o, e) = select.select(self.sockets.values(), writers, [], timeout)
+        except select.error, x:
+            if x.args[0] == errno.EINTR:
+                return [], []
+            raise
+        return i, o
+
+
+class PollReactor(Reactor):
+    """Reactor backend using select.poll()."""
+
+    def __init__(self):
+        Reactor.__init__(self)
+        self._poll = select.poll()
+        self._READ = select.POLLIN | select.POLLPRI
+        self._READY = self._READ | select.POLLHUP | select.POLLERR
+
+    def _add(self, fd):
+        self._poll.register(fd, self._READ)
+
+    def _remove(self, fd):
+        try:
+            self._poll.unregister(fd)
+        except KeyError:
+            pass
+
+    def _modify(self, fd, writable):
+        if writable:
+            self._poll.modify(fd, self._READ | select.POLLOUT)
+        else:
+            self._poll.modify(fd, self._READ)
+
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            events = self._poll.poll(timeout)
+        except select.error, x:
+            if x.args[0] == errno.EINTR:
+                return [], []
+            raise
+        return _ready_sockets(self.sockets, events, self._READY, select.POLLOUT)
+
+
+class EpollReactor(Reactor):
+    """Reactor backend using select.epoll() (Linux only)."""
+
+    def __init__(self):
+        Reactor.__init__(self)
+        self._epoll = select.epoll()
+        self._READ = select.EPOLLIN | select.EPOLLPRI
+        self._READY = self._READ | select.EPOLLHUP | select.EPOLLERR
+
+    def _add(self, fd):
+        self._epoll.register(fd, self._READ)
+
+    def _remove(self, fd):
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # The descriptor is already closed.
+            pass
+
+    def _modify(self, fd, writable):
+        if writable:
+            self._epoll.modify(fd, self._READ | select.EPOLLOUT)
+        else:
+            self._epoll.modify(fd, self._READ)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError, x:
+            if x.errno == errno.EINTR:
+                return [], []
+            raise
+        return _ready_sockets(self.sockets, events, self._READY, select.EPOLLOUT)
+
+
+def _ready_sockets(sockets, events, readmask, writemask):
+    """[Internal] Split (fd, mask) tuples into readable and writable
+    socket lists.  Hangups and errors count as readable, so the
+    connection notices them when reading."""
+    readable = []
+    writable = []
+    for fd, mask in events:
+        sock = sockets.get(fd)
+        if sock is None:
+            continue
+        if mask & readmask:
+            readable.append(sock)
+        if mask & writemask:
+            writable.append(sock)
+    return readable, writable
+
+def _find_monotonic_clock():
+    """[Internal] Returns the best monotonic clock function available.
+
+    Falls back to time.time if the platform has no monotonic clock.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    if not sys.platform.startswith("linux"):
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long),
+                        ("tv_nsec", ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or None)
+        clock_gettime = librt.clock_gettime
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            ts = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                return time.time()
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+monotonic = _find_monotonic_clock()
+
+# Longest time (in seconds) process_once waits in the reactor.  Larger
+# values would overflow the poll and epoll timeout arguments.
+_MAX_POLL_TIMEOUT = 3600.0
+
+class DelayedCommand:
+    """A function scheduled by IRC.execute_at or IRC.execute_delayed.
+
+    The object is a handle to the scheduled call.  Calling its cancel
+    method prevents a pending call from being executed.
+    """
+    def __init__(self, irclibobj, due, function, arguments):
+        self.irclibobj = irclibobj
+        self.due = due  # monotonic() time
+        self.function = function
+        self.arguments = arguments
+        self.cancelled = 0
+
+    def cancel(self):
+        """Cancel the call if it has not been executed yet."""
+        if not self.cancelled:
+            self.cancelled = 1
+            self.irclibobj._delayed_command_cancelled()
+
+    def remaining(self):
+        """Returns the number of seconds until the call is due."""
+        return max(0, self.due - monotonic())
+
+
+def default_reactor():
+    """Returns the best reactor backend available on this platform.
+
+    epoll is preferred, then poll and finally select.
+    """
+    if hasattr(select, "epoll"):
+        return EpollReactor()
+    if hasattr(select, "poll"):
+        return PollReactor()
+    return SelectReactor()
+
+
 class IRC:
     """Class that handles one or several IRC server connections.
 
@@ -123,12 +407,16 @@ class IRC:
 
     def __init__(self, fn_to_add_socket=None,
                  fn_to_remove_socket=None,
-                 fn_to_add_timeout=None):
+                 fn_to_add_timeout=None,
+                 reactor=None,
+                 resolver=None,
+                 fn_to_watch_write=None):
         """Constructor for IRC objects.
 
-        Optional arguments are fn_to_add_socket, fn_to_remove_socket
-        and fn_to_add_timeout.  The first two specify functions that
-        will be called with a socket object as argument when the IRC
+        Optional arguments are fn_to_add_socket, fn_to_remove_socket,
+        fn_to_add_timeout, reactor, resolver and fn_to_watch_write.
+        The first two specify functions
+        that will be called with a socket object as argument when the IRC
         object wants to be notified (or stop being notified) of data
         coming on a new socket.  When new data arrives, the method
         process_data should be called.  Similarly, fn_to_add_timeout
@@ -139,25 +427,71 @@ class IRC:
         process_timeout method to be called after 42 seconds and 170
         milliseconds.
 
-        The three arguments mainly exist to be able to use an external
+        fn_to_watch_write is called with a socket object and a flag
+        when the IRC object wants to be notified (flag is true) or no
+        longer notified (flag is false) of the socket becoming
+        writable, which happens when output could not be sent right
+        away.  When it is writable, the method process_write should be
+        called with a list of the sockets.  Without fn_to_watch_write,
+        such output is sent blocking instead, and non-blocking connects
+        (which wait for writability) can't be used.
+
+        The four arguments mainly exist to be able to use an external
         main loop (for example Tkinter's or PyGTK's main app loop)
         instead of calling the process_forever method.
 
         An alternative is to just call ServerConnection.process_once()
         once in a while.
+
+        reactor is the Reactor object used by process_once.  It
+        defaults to the best backend available (see default_reactor).
+        If no external functions are given, the reactor's register,
+        unregister and watch_write methods are used as
+        fn_to_add_socket, fn_to_remove_socket and fn_to_watch_write.
+
+        resolver is used by non-blocking connects to look up host
+        names.  It is called as resolver(host, port, family, callback)
+        and must (eventually) call callback(addresses, error) from the
+        thread running the IRC object, with addresses being a list of
+        socket.getaddrinfo results.  See IRC.resolve for the default,
+        which resolves in a separate thread.
         """
 
+        if reactor is None:
+            reactor = default_reactor()
+        self.reactor = reactor
+
         if fn_to_add_socket and fn_to_remove_socket:
             self.fn_to_add_socket = fn_to_add_socket
             self.fn_to_remove_socket = fn_to_remove_socket
+            self.fn_to_watch_write = fn_to_watch_write
         else:
-            self.fn_to_add_socket = None
-            self.fn_to_remove_socket = None
+            self.fn_to_add_socket = reactor.register
+            self.fn_to_remove_socket = reactor.unregister
+            self.fn_to_watch_write = reactor.watch_write
 
         self.fn_to_add_timeout = fn_to_add_timeout
+        # Receive buffer shared by all connections.  Connections are
+        # processed one at a time, so they never use it concurrently.
+        self.recv_buffer = bytearray(2**14)
+        self.recv_view = memoryview(self.recv_buffer)
         self.connections = []
-        self.handlers = {}
-        self.delayed_commands = [] # list of tuples in the format (time, function, arguments)
+        self.connections_by_fd = {}  # socket fd -> Connection
+        self.handlers = {}  # event type -> sorted list of (priority, sequence, handler)
+        self._handler_sequence = itertools.count()
+        self._handler_cache = {}  # event type -> tuple of handlers to call
+        self.delayed_commands = [] # heap of tuples in the format (due, sequence, DelayedCommand)
+        self._delayed_sequence = itertools.count()
+        self._delayed_cancelled = 0
+        self.resolver = resolver or self.resolve
+        # While dispatching, output is flushed once at the end (see
+        # Connection._write).
+        self._dispatching = 0
+        self._unflushed = {}  # Connection -> 1
+        # Lets other threads hand work to the thread running process_once.
+        self._waker = _Waker()
+        self._add_socket(self._waker, self._waker.reader)
+        self._stopped = 0  # See stop.
 
         self.add_global_handler("ping", _ping_ponger, -42)
 
@@ -168,6 +502,28 @@ class IRC:
         self.connections.append(c)
         return c
 
+    def has_handlers(self, eventtype, connection=None):
+        """Check whether events of a type would be handled at all.
+
+        Arguments:
+
+            eventtype -- Event type (a string).
+
+            connection -- If given, the connection's own handlers
+                          are checked too.
+
+        Returns true if a global handler is registered for the event
+        type or for "all_events", or if the connection has a handler
+        for it.  Connections use this to skip parsing and building
+        events nobody listens to.
+        """
+        handlers = self._handler_cache.get(eventtype)
+        if handlers is None:
+            handlers = self._handlers_for(eventtype)
+        if handlers:
+            return 1
+        return connection is not None and eventtype in connection.handlers
+
     def process_data(self, sockets):
         """Called when there is more data to read on connection sockets.
 
@@ -177,64 +533,187 @@ class IRC:
 
         See documentation for IRC.__init__.
         """
-        for s in sockets:
-            for c in self.connections:
-                if s == c._get_socket():
+        lookup = self.connections_by_fd.get
+        self._dispatching = self._dispatching + 1
+        try:
+            for s in sockets:
+                try:
+                    c = lookup(s.fileno())
+                except socket.error:
+                    # Closed by a handler earlier in this tick.
+                    continue
+                if c is not None:
                     c.process_data()
+        finally:
+            self._end_dispatch()
+
+    def process_write(self, sockets):
+        """Called when connection sockets with pending output are
+        writable.
+
+        Arguments:
+
+            sockets -- A list of socket objects.
+
+        Sends as much of the connections' send buffers as possible.
+        """
+        lookup = self.connections_by_fd.get
+        for s in sockets:
+            try:
+                c = lookup(s.fileno())
+            except socket.error:
+                continue
+            if c is not None:
+                c.flush()
 
     def process_timeout(self):
         """Called when a timeout notification is due.
 
         See documentation for IRC.__init__.
         """
-        t = time.time()
-        while self.delayed_commands:
-            if t >= self.delayed_commands[0][0]:
-                self.delayed_commands[0][1](*self.delayed_commands[0][2])
-                del self.delayed_commands[0]
-            else:
-                break
+        t = monotonic()
+        q = self.delayed_commands
+        self._dispatching = self._dispatching + 1
+        try:
+            while q and t >= q[0][0]:
+                command = heapq.heappop(q)[2]
+                if command.cancelled:
+                    self._delayed_cancelled = self._delayed_cancelled - 1
+                    continue
+                # Mark it as done so that a late cancel() is a no-op.
+                command.cancelled = 1
+                command.function(*command.arguments)
+        finally:
+            self._end_dispatch()
+
+    def time_to_next_command(self):
+        """Returns the number of seconds until the next delayed command
+        is due, or None if no command is scheduled."""
+        q = self.delayed_commands
+        while q and q[0][2].cancelled:
+            heapq.heappop(q)
+            self._delayed_cancelled = self._delayed_cancelled - 1
+        if not q:
+            return None
+        return max(0, q[0][0] - monotonic())
 
     def process_once(self, timeout=0):
         """Process data from connections once.
 
         Arguments:
 
-            timeout -- How long the select() call should wait if no
-                       data is available.
+            timeout -- How long the reactor should wait if no data is
+                       available.  The wait is shortened if a delayed
+                       command is due earlier.  None means wait until
+                       data arrives or the next delayed command is due.
 
         This method should be called periodically to check and process
         incoming data, if there are any.  If that seems boring, look
         at the process_forever method.
         """
-        sockets = map(lambda x: x._get_socket(), self.connections)
-        sockets = filter(lambda x: x != None, sockets)
-        if sockets:
-            (i, o, e) = select.select(sockets, [], [], timeout)
-            self.process_data(i)
-        else:
-            time.sleep(timeout)
+        delay = self.time_to_next_command()
+        if delay is not None and (timeout is None or delay < timeout):
+            # poll and epoll truncate to milliseconds; don't wake up
+            # right before the command is due.
+            timeout = delay and delay + 0.001
+        if timeout is not None and timeout > _MAX_POLL_TIMEOUT:
+            timeout = _MAX_POLL_TIMEOUT
+        readable, writable = self.reactor.poll(timeout)
+        if writable:
+            self.process_write(writable)
+        if readable:
+            self.process_data(readable)
 
         self.process_timeout()
 
-    def process_forever(self, timeout=0.2):
+    def process_forever(self, timeout=None):
         """Run an infinite loop, processing data from connections.
 
-        This method repeatedly calls process_once.
+        This method repeatedly calls process_once, until stop is
+        called.
 
         Arguments:
 
-            timeout -- Parameter to pass to process_once.
+            timeout -- Parameter to pass to process_once.  The default
+                       sleeps until data arrives or the next delayed
+                       command is due, instead of polling.
         """
-        while 1:
+        while not self._stopped:
             self.process_once(timeout)
+        self._stopped = 0
+
+    def stop(self):
+        """Make process_forever return after the current process_once.
+
+        Like all methods but call_soon_threadsafe, stop must be called
+        from the thread running the IRC object.
+        """
+        self._stopped = 1
+
+    def call_soon_threadsafe(self, function, arguments=()):
+        """Call function from the thread running the IRC object.
+
+        Arguments:
+
+            function -- Function to call.
+
+            arguments -- Arguments to give the function.
+
+        This is the only IRC method that may be called from other
+        threads.  The function is called on the next process_once,
+        which is woken up if it is waiting for data.
+        """
+        self._waker.call(function, arguments)
+
+    def add_reader(self, sock, function, arguments=()):
+        """Call a function whenever a socket has data to read.
+
+        Arguments:
+
+            sock -- A socket object (not belonging to a connection).
+
+            function -- Function to call.
+
+            arguments -- Arguments to give the function.
+
+        This lets other sockets (e.g. a listening socket) be served by
+        the same loop as the IRC connections.  Use remove_reader
+        before closing the socket.
+        """
+        self._add_socket(_Reader(sock, function, arguments), sock)
+
+    def remove_reader(self, sock):
+        """Stop calling the function given to add_reader for sock."""
+        reader = self.connections_by_fd.get(sock.fileno())
+        if isinstance(reader, _Reader):
+            self._remove_socket(reader, sock)
+
+    def resolve(self, host, port, family, callback):
+        """Look up a host name without blocking the caller.
+
+        The default resolver of non-blocking connects: runs
+        socket.getaddrinfo in a separate thread and hands the result
+        back with call_soon_threadsafe.  See IRC.__init__.
+        """
+        def lookup():
+            try:
+                addresses = socket.getaddrinfo(host, port, family,
+                                               socket.SOCK_STREAM)
+            except socket.error, x:
+                self.call_soon_threadsafe(callback, (None, x))
+            else:
+                self.call_soon_threadsafe(callback, (addresses, None))
+        t = threading.Thread(target=lookup, name="resolve %s" % host)
+        t.setDaemon(1)
+        t.start()
 
     def on_socketread(self):
         pass
 
     def disconnect_all(self, message=""):
         """Disconnects all connections."""
-        for c in self.connections:
+        # Disconnecting removes the connection from the list.
+        for c in self.connections[:]:
             c.disconnect(message)
 
     def add_global_handler(self, event, handler, priority=0):
@@ -255,12 +734,17 @@ class IRC:
         the Event class.
 
         The handler functions are called in priority order (lowest
-        number is highest priority).  If a handler function returns
-        \"NO MORE\", no more handlers will be called.
+        number is highest priority).  Handlers for \"all_events\" are
+        merged with the handlers for the specific event type; handlers
+        with equal priority are called in the order they were added.
+        If a handler function returns \"NO MORE\", no more handlers will
+        be called.
         """
         if not event in self.handlers:
             self.handlers[event] = []
-        bisect.insort(self.handlers[event], ((priority, handler)))
+        bisect.insort(self.handlers[event],
+                      (priority, self._handler_sequence.next(), handler))
+        self._handler_cache.clear()
 
     def remove_global_handler(self, event, handler):
         """Removes a global handler function.
@@ -275,9 +759,13 @@ class IRC:
         """
         if not event in self.handlers:
             return 0
-        for h in self.handlers[event]:
-            if handler == h[1]:
-                self.handlers[event].remove(h)
+        handlers = [h for h in self.handlers[event] if handler != h[2]]
+        if handlers:
+            self.handlers[event] = handlers
+        else:
+            # Keep has_handlers accurate.
+            del self.handlers[event]
+        self._handler_cache.clear()
         return 1
 
     def execute_at(self, at, function, arguments=()):
@@ -290,8 +778,10 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+        Returns a DelayedCommand that can be used to cancel the call.
         """
-        self.execute_delayed(at-time.time(), function, arguments)
+        return self.execute_delayed(at-time.time(), function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
         """Execute a function after a specified time.
@@ -303,60 +793,345 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+        Returns a DelayedCommand that can be used to cancel the call.
+        Commands due at the same time are executed in the order they
+        were scheduled.
         """
-        bisect.insort(self.delayed_commands, (delay+time.time(), function, arguments))
+        command = DelayedCommand(self, monotonic() + delay, function, arguments)
+        heapq.heappush(self.delayed_commands,
+                       (command.due, self._delayed_sequence.next(), command))
         if self.fn_to_add_timeout:
             self.fn_to_add_timeout(delay)
-
-    def dcc(self, dcctype="chat"):
+        return command
+
+    def _delayed_command_cancelled(self):
+        """[Internal] Drop cancelled commands once they dominate the heap."""
+        self._delayed_cancelled = self._delayed_cancelled + 1
+        q = self.delayed_commands
+        if self._delayed_cancelled > 64 and self._delayed_cancelled * 2 > len(q):
+            q[:] = [entry for entry in q if not entry[2].cancelled]
+            heapq.heapify(q)
+            self._delayed_cancelled = 0
+
+    def dcc(self, dcctype="chat", max_line_length=None):
         """Creates and returns a DCCConnection object.
 
         Arguments:
 
             dcctype -- "chat" for DCC CHAT connections or "raw" for
-                       DCC SEND (or other DCC types). If "chat",
+                       receiving DCC SEND (or other DCC types), see
+                       dcc_send for sending files. If "chat",
                        incoming data will be split in newline-separated
                        chunks. If "raw", incoming data is not touched.
+
+            max_line_length -- Longest unfinished line a "chat" peer
+                               may send before it is disconnected.
+                               Defaults to
+                               DCCConnection.max_line_length.
+        """
+        c = DCCConnection(self, dcctype, max_line_length)
+        self.connections.append(c)
+        return c
+
+    def dcc_send(self, path, rate=None):
+        """Creates and returns a DCCSendConnection object.
+
+        Arguments:
+
+            path -- Path of the file to send.
+
+            rate -- Maximum number of bytes per second to send, or
+                    None for no limit.
+
+        Raises DCCConnectionError if the file can't be opened.  See
+        SimpleIRCClient.dcc_send for offering the file to a user.
         """
-        c = DCCConnection(self, dcctype)
+        c = DCCSendConnection(self, path, rate)
         self.connections.append(c)
         return c
 
+    def _end_dispatch(self):
+        """[Internal] Flush the output of the handlers called since
+        dispatching started."""
+        self._dispatching = self._dispatching - 1
+        if self._dispatching:
+            return
+        while self._unflushed:
+            connections, self._unflushed = self._unflushed, {}
+            for c in connections:
+                if c.socket is not None:
+                    c.flush()
+
+    def _handlers_for(self, eventtype):
+        """[Internal] Returns the priority sorted tuple of handlers for
+        an event type, including the all_events handlers.
+
+        The tuple is cached until a global handler is added or removed.
+        """
+        try:
+            return self._handler_cache[eventtype]
+        except KeyError:
+            pass
+        h = self.handlers
+        entries = h.get("all_events", []) + h.get(eventtype, [])
+        entries.sort()
+        handlers = tuple([entry[2] for entry in entries])
+        self._handler_cache[eventtype] = handlers
+        return handlers
+
     def _handle_event(self, connection, event):
         """[Internal]"""
-        h = self.handlers
-        for handler in h.get("all_events", []) + h.get(event.eventtype(), []):
-            if handler[1](connection, event) == "NO MORE":
+        handlers = self._handler_cache.get(event._eventtype)
+        if handlers is None:
+            handlers = self._handlers_for(event._eventtype)
+        for handler in handlers:
+            if handler(connection, event) == "NO MORE":
                 return
 
+    def _add_socket(self, connection, sock):
+        """[Internal] Start watching the socket of a connection."""
+        self.connections_by_fd[sock.fileno()] = connection
+        if self.fn_to_add_socket:
+            self.fn_to_add_socket(sock)
+
+    def _remove_socket(self, connection, sock):
+        """[Internal] Stop watching the socket of a connection.
+
+        Must be called before the socket is closed.
+        """
+        if sock is None:
+            return
+        try:
+            fd = sock.fileno()
+        except socket.error:
+            fd = None
+        if self.connections_by_fd.get(fd) is connection:
+            del self.connections_by_fd[fd]
+        if self.fn_to_remove_socket:
+            self.fn_to_remove_socket(sock)
+
+    def _watch_write(self, connection, flag):
+        """[Internal] Start or stop waiting for a connection's socket
+        to become writable."""
+        if connection._write_watched == flag:
+            return
+        if self.fn_to_watch_write is None:
+            if flag:
+                self._flush_blocking(connection)
+            return
+        connection._write_watched = flag
+        self.fn_to_watch_write(connection._get_socket(), flag)
+
+    def _flush_blocking(self, connection):
+        """[Internal] Send the pending output of a connection blocking,
+        for external main loops that can't watch for writability."""
+        sock = connection._get_socket()
+        if sock is None or getattr(connection, "connecting", 0):
+            return
+        # Keeps the flush below from coming back here.
+        connection._write_watched = True
+        sock.setblocking(1)
+        try:
+            connection.flush()
+        finally:
+            connection._write_watched = False
+            if connection._get_socket() is sock:
+                sock.setblocking(0)
+
     def _remove_connection(self, connection):
         """[Internal]"""
         self.connections.remove(connection)
-        if self.fn_to_remove_socket:
-            self.fn_to_remove_socket(connection._get_socket())
+        self._remove_socket(connection, connection._get_socket())
+
+class SendBufferFullError(IRCError):
+    """Raised when data is sent on a connection whose send buffer has
+    reached its high-water mark."""
+    pass
 
-_rfc_1459_command_regexp = re.compile("^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
+def _tls_context(ssl):
+    """[Internal] Returns the ssl.SSLContext to use for the ssl argument
+    of ServerConnection.connect."""
+    if _tls is None:
+        raise ServerConnectionError, "The ssl module is not available."
+    if isinstance(ssl, _tls.SSLContext):
+        return ssl
+    return _tls.create_default_context()
+
+def _socketpair():
+    """[Internal] Returns a pair of connected sockets."""
+    if hasattr(socket, "socketpair"):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        a.connect(listener.getsockname())
+        b = listener.accept()[0]
+    finally:
+        listener.close()
+    return a, b
+
+class _Reader:
+    """[Internal] Stands in for a connection on sockets given to
+    IRC.add_reader."""
+
+    def __init__(self, sock, function, arguments):
+        self.socket = sock
+        self.function = function
+        self.arguments = arguments
+
+    def _get_socket(self):
+        return self.socket
+
+    def process_data(self):
+        self.function(*self.arguments)
+
+    def flush(self):
+        return 1
+
+class _Waker:
+    """[Internal] Runs calls queued by other threads in the thread
+    polling the reactor.
+
+    The reading end of a socket pair is watched like a connection's
+    socket; queueing a call writes a byte to the other end so that a
+    waiting poll returns.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = _socketpair()
+        self.reader.setblocking(0)
+        self.writer.setblocking(0)
+        self.calls = collections.deque()
+
+    def _get_socket(self):
+        return self.reader
+
+    def call(self, function, arguments):
+        self.calls.append((function, arguments))
+        try:
+            self.writer.send("x")
+        except socket.error:
+            # The pipe is full, so a wakeup is pending anyway.
+            pass
+
+    def process_data(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+        calls = self.calls
+        while calls:
+            function, arguments = calls.popleft()
+            function(*arguments)
+
+    def flush(self):
+        return 1
 
 class Connection:
     """Base class for IRC connections.
 
     Must be overridden.
+
+    Outgoing data is appended to a send buffer and written to the
+    socket without blocking.  Whatever the socket does not accept
+    right away is sent by the reactor when the socket becomes
+    writable.  If more than send_buffer_limit bytes are pending,
+    sending raises SendBufferFullError instead of queueing more data;
+    use send_buffer_space to check beforehand.
     """
+
+    # High-water mark of the send buffer, in bytes.
+    send_buffer_limit = 2**18
+
     def __init__(self, irclibobj):
         self.irclibobj = irclibobj
+        self.socket = None
+        self.send_buffer = bytearray()
+        self._write_watched = False
+        self._flush_lock = threading.Lock()
 
     def _get_socket():
         raise IRCError, "Not overridden"
 
+    def send_buffer_space(self):
+        """Returns how many bytes can still be sent before the send
+        buffer reaches its high-water mark."""
+        return max(0, self.send_buffer_limit - len(self.send_buffer))
+
+    def flush(self):
+        """Write as much of the send buffer as the socket accepts
+        without blocking.
+
+        Returns true if the send buffer is empty afterwards.
+        """
+        # Another thread is flushing; it will pick up our data too.
+        if not self._flush_lock.acquire(0):
+            return 0
+        failed = 0
+        try:
+            buf = self.send_buffer
+            while buf and self.socket is not None:
+                try:
+                    n = self.socket.send(buf)
+                except socket.error, x:
+                    if x.args[0] not in _WOULD_BLOCK \
+                           and not isinstance(x, _TLS_WOULD_BLOCK):
+                        failed = 1
+                        del buf[:]
+                    break
+                del buf[:n]
+        finally:
+            self._flush_lock.release()
+        if failed:
+            # Ouch!
+            self.disconnect("Connection reset by peer.")
+            return 1
+        if self.socket is None:
+            return not self.send_buffer
+        pending = len(self.send_buffer) > 0
+        self.irclibobj._watch_write(self, pending)
+        return not pending
+
+    def _write(self, data, force=0):
+        """[Internal] Append data to the send buffer and try to send it.
+
+        While the IRC object dispatches events or delayed commands,
+        sending is put off until it is done, so that all lines
+        written by the handlers go out with one send per connection.
+
+        Raises SendBufferFullError if the buffer would grow above
+        send_buffer_limit, unless force is true.
+        """
+        if not force and len(self.send_buffer) + len(data) > self.send_buffer_limit:
+            raise SendBufferFullError, "Send buffer full."
+        self.send_buffer += data
+        if self.irclibobj._dispatching:
+            self.irclibobj._unflushed[self] = 1
+        else:
+            self.flush()
+
     ##############################
     ### Convenience wrappers.
 
     def execute_at(self, at, function, arguments=()):
-        self.irclibobj.execute_at(at, function, arguments)
+        return self.irclibobj.execute_at(at, function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
-        self.irclibobj.execute_delayed(delay, function, arguments)
+        return self.irclibobj.execute_delayed(delay, function, arguments)
+
 
+# errno values meaning a non-blocking socket operation has to be retried.
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# The same for operations on non-blocking SSL sockets.
+if _tls is not None:
+    _TLS_WOULD_BLOCK = (_tls.SSLWantReadError, _tls.SSLWantWriteError)
+else:
+    _TLS_WOULD_BLOCK = ()
 
 class ServerConnectionError(IRCError):
     pass
@@ -365,9 +1140,229 @@ class ServerNotConnectedError(ServerConnectionError):
     pass
 
 
-# Huh!?  Crrrrazy EFNet doesn't follow the RFC: their ircd seems to
-# use \n as message separator!  :P
-_linesep_regexp = re.compile("\r?\n")
+class LineBuffer:
+    """A buffer splitting received data into lines.
+
+    Data is appended to a bytearray and scanned for line terminators in
+    place.  Complete lines are removed from the front of the buffer, so
+    only the unfinished last line is kept, and the part of it that has
+    already been scanned is not scanned again on the next feed.
+
+    Lines are terminated by LF; a CR in front of the LF is stripped.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._scanned = 0  # Bytes at the front known to contain no LF.
+
+    def __len__(self):
+        """Returns the length of the unfinished line."""
+        return len(self.buffer)
+
+    def feed(self, data):
+        """Append data (a string, bytearray or memoryview)."""
+        self.buffer += data
+
+    def lines(self):
+        """Returns a list of all complete lines and removes them from
+        the buffer."""
+        buf = self.buffer
+        find = buf.find
+        lines = []
+        start = 0
+        pos = find("\n", self._scanned)
+        while pos != -1:
+            end = pos
+            if end > start and buf[end - 1] == 13:  # CR
+                end = end - 1
+            lines.append(str(buf[start:end]))
+            start = pos + 1
+            pos = find("\n", start)
+        if start:
+            del buf[:start]
+        self._scanned = len(buf)
+        return lines
+
+    def clear(self):
+        """Discard all buffered data."""
+        del self.buffer[:]
+        self._scanned = 0
+
+
+class TokenBucket:
+    """A token bucket rate limiter.
+
+    The bucket holds up to burst tokens and is refilled with rate
+    tokens per second.  A rate of None means unlimited.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = monotonic()
+
+    def _refill(self, now):
+        if self.tokens < self.burst:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, amount, now):
+        """Returns how many seconds to wait until amount tokens are
+        available (0 if they are available now)."""
+        if self.rate is None:
+            return 0
+        self._refill(now)
+        # Never wait for more than a full bucket.
+        amount = min(amount, self.burst)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        """Take amount tokens out of the bucket."""
+        if self.rate is not None:
+            self.tokens = self.tokens - amount
+
+
+class FloodControl:
+    """Outbound scheduler limiting the rate of lines sent to a server.
+
+    Lines are released to the connection's send buffer only as fast
+    as two token buckets allow: one counting lines and one counting
+    bytes.  Lines in the priority lane (PONG, registration and
+    NickServ traffic) are released before all other lines.  The other
+    lines are queued per target (the channel or nick of a PRIVMSG or
+    NOTICE) and released round-robin, so one busy target can not
+    starve the others.
+
+    FloodControl objects are created by ServerConnection.set_rate_limit.
+    """
+
+    def __init__(self, connection, lines_per_second, bytes_per_second,
+                 burst_lines, burst_bytes):
+        self.connection = connection
+        self.lines = TokenBucket(lines_per_second, burst_lines)
+        self.bytes = TokenBucket(bytes_per_second, burst_bytes)
+        self.priority = collections.deque()  # (queued at, data)
+        self.queues = {}  # target -> deque of (queued at, data)
+        self.targets = collections.deque()  # round-robin order of self.queues
+        self.queued_bytes = 0
+        self.timer = None
+        self.lock = threading.RLock()
+        self.sent_lines = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        """Returns the number of queued lines."""
+        return len(self.priority) + sum(map(len, self.queues.values()))
+
+    def enqueue(self, data, target=None, priority=0):
+        """Queue data (a line including CR LF) and release what the
+        rate limit allows."""
+        self.lock.acquire()
+        try:
+            entry = (monotonic(), data)
+            if priority:
+                self.priority.append(entry)
+            else:
+                queue = self.queues.get(target)
+                if queue is None:
+                    queue = self.queues[target] = collections.deque()
+                    self.targets.append(target)
+                queue.append(entry)
+            self.queued_bytes = self.queued_bytes + len(data)
+            if self.timer is None:
+                self.pump()
+        finally:
+            self.lock.release()
+
+    def pump(self):
+        """Release queued lines while the token buckets allow it."""
+        self.lock.acquire()
+        try:
+            self.timer = None
+            now = monotonic()
+            while self.priority or self.targets:
+                if self.priority:
+                    queue = self.priority
+                else:
+                    queue = self.queues[self.targets[0]]
+                queued_at, data = queue[0]
+                wait = max(self.lines.delay(1, now),
+                           self.bytes.delay(len(data), now))
+                if wait:
+                    self.timer = self.connection.execute_delayed(wait, self.pump)
+                    break
+                self.lines.consume(1)
+                self.bytes.consume(len(data))
+                queue.popleft()
+                if queue is not self.priority:
+                    target = self.targets.popleft()
+                    if queue:
+                        self.targets.append(target)
+                    else:
+                        del self.queues[target]
+                self.queued_bytes = self.queued_bytes - len(data)
+                self.sent_lines = self.sent_lines + 1
+                self.total_wait = self.total_wait + (now - queued_at)
+                self.max_wait = max(self.max_wait, now - queued_at)
+                self.connection._write(data, 1)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Drop all queued lines."""
+        self.lock.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.priority.clear()
+            self.queues.clear()
+            self.targets.clear()
+            self.queued_bytes = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Returns a dictionary with queue metrics.
+
+        The keys are queued_lines, queued_bytes, queued_targets (the
+        number of queued lines per target), oldest_wait (how long the
+        oldest queued line has been waiting), sent_lines, average_wait
+        and max_wait (over the released lines).  Times are in seconds.
+        """
+        self.lock.acquire()
+        try:
+            now = monotonic()
+            oldest = [q[0][0] for q in self.queues.values() if q]
+            if self.priority:
+                oldest.append(self.priority[0][0])
+            queued_targets = {}
+            for target, queue in self.queues.items():
+                queued_targets[target] = len(queue)
+            average_wait = 0.0
+            if self.sent_lines:
+                average_wait = self.total_wait / self.sent_lines
+            return {"queued_lines": len(self),
+                    "queued_bytes": self.queued_bytes,
+                    "queued_targets": queued_targets,
+                    "oldest_wait": oldest and now - min(oldest) or 0.0,
+                    "sent_lines": self.sent_lines,
+                    "average_wait": average_wait,
+                    "max_wait": self.max_wait}
+        finally:
+            self.lock.release()
+
+# Commands FloodControl sends in the priority lane.
+_priority_commands = frozenset(["PASS", "NICK", "USER", "PING", "PONG"])
+
+# PRIVMSG/NOTICE targets FloodControl sends in the priority lane.
+_priority_targets = frozenset(["NICKSERV", "NICKSERV@SERVICES.DAL.NET"])
+
 
 class ServerConnection(Connection):
     """This class represents an IRC server connection.
@@ -379,11 +1374,50 @@ class ServerConnection(Connection):
     def __init__(self, irclibobj):
         Connection.__init__(self, irclibobj)
         self.connected = 0  # Not connected yet.
+        self.connecting = 0  # Non-blocking connect in progress.
         self.socket = None
         self.ssl = None
+        self._handshaking = 0
+        self.flood_control = None
+        self._connect_attempt = 0
+        self._connect_timer = None
+        self._addresses = []
+        self.real_userhost = None
+        self.isupport = {}
+
+    def set_rate_limit(self, lines_per_second=None, bytes_per_second=None,
+                       burst_lines=5, burst_bytes=2048):
+        """Enable (or disable) flood control for outgoing lines.
+
+        Arguments:
+
+            lines_per_second -- Sustained number of lines per second.
+
+            bytes_per_second -- Sustained number of bytes per second.
+
+            burst_lines -- Number of lines that may be sent at once
+                           before the line rate applies.
+
+            burst_bytes -- Number of bytes that may be sent at once
+                           before the byte rate applies.
+
+        A rate of None is not limited.  If both rates are None, flood
+        control is disabled and lines are sent immediately.  See
+        FloodControl for how lines are scheduled, and its stats method
+        for queue metrics (available as self.flood_control).
+        """
+        if self.flood_control is not None:
+            self.flood_control.clear()
+            self.flood_control = None
+        if lines_per_second is None and bytes_per_second is None:
+            return
+        self.flood_control = FloodControl(self, lines_per_second,
+                                          bytes_per_second, burst_lines,
+                                          burst_bytes)
 
     def connect(self, server, port, nickname, password=None, username=None,
-                ircname=None, localaddress="", localport=0, ssl=False, ipv6=False):
+                ircname=None, localaddress="", localport=0, ssl=False, ipv6=False,
+                nonblocking=False, timeout=30):
         """Connect/reconnect to a server.
 
         Arguments:
@@ -404,21 +1438,43 @@ class ServerConnection(Connection):
 
             localport -- Bind the connection to a specific local port.
 
-            ssl -- Enable support for ssl.
+            ssl -- Use TLS: either true, to verify the server's
+                   certificate against the system's CAs, or an
+                   ssl.SSLContext to use.
 
             ipv6 -- Enable support for ipv6.
 
+            nonblocking -- Return immediately and connect in the
+                           background (see below).
+
+            timeout -- Seconds a non-blocking connect may take.
+
         This function can be called to reconnect a closed connection.
 
+        In non-blocking mode the server name is looked up with the
+        IRC object's resolver and the connection is established by
+        the reactor (including the TLS handshake, if any) while other
+        connections are served.  Until then
+        is_connecting returns true.  When the connection is up, the
+        client logs on; if it fails or takes longer than timeout
+        seconds, a "connect_failed" event is triggered with the reason
+        as argument.
+
         Returns the ServerConnection object.
         """
         if self.connected:
             self.disconnect("Changing servers")
+        elif self.connecting:
+            self._abort_connect()
 
-        self.previous_buffer = ""
+        if self.flood_control is not None:
+            self.flood_control.clear()
+        self.buffer = LineBuffer()
         self.handlers = {}
         self.real_server_name = ""
         self.real_nickname = nickname
+        self.real_userhost = None
+        self.isupport = {}
         self.server = server
         self.port = port
         self.nickname = nickname
@@ -428,29 +1484,163 @@ class ServerConnection(Connection):
         self.localaddress = localaddress
         self.localport = localport
         self.localhost = socket.gethostname()
+        self.ssl = None
+        self._handshaking = 0
+        self.ssl_context = None
+        if ssl:
+            self.ssl_context = _tls_context(ssl)
+        del self.send_buffer[:]
+        self._write_watched = False
         if ipv6:
-            self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            family = socket.AF_INET6
         else:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            family = socket.AF_INET
+
+        if nonblocking:
+            self.connecting = 1
+            self._connect_attempt = self._connect_attempt + 1
+            self._connect_timer = self.execute_delayed(
+                timeout, self._connect_failed, ("Connection timed out",))
+            attempt = self._connect_attempt
+            def resolved(addresses, error):
+                if attempt == self._connect_attempt and self.connecting:
+                    self._resolved(addresses, error)
+            self.irclibobj.resolver(server, port, family, resolved)
+            return self
+
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
         try:
             self.socket.bind((self.localaddress, self.localport))
             self.socket.connect((self.server, self.port))
-            if ssl:
-                self.ssl = socket.ssl(self.socket)
-        except socket.error, x:
+            if self.ssl_context is not None:
+                self.socket = self.ssl = self.ssl_context.wrap_socket(
+                    self.socket, server_hostname=self.server)
+        except (socket.error, ValueError), x:
+            # (ssl.CertificateError is a ValueError.)
             self.socket.close()
             self.socket = None
             raise ServerConnectionError, "Couldn't connect to socket: %s" % x
+        self._connected()
+        return self
+
+    def _connected(self):
+        """[Internal] Start using the connected socket and log on."""
+        self.socket.setblocking(0)
         self.connected = 1
-        if self.irclibobj.fn_to_add_socket:
-            self.irclibobj.fn_to_add_socket(self.socket)
+        if self.connecting:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+            self.irclibobj._watch_write(self, False)
+        else:
+            self.irclibobj._add_socket(self, self.socket)
+        self.connecting = 0
 
         # Log on...
         if self.password:
             self.pass_(self.password)
         self.nick(self.nickname)
         self.user(self.username, self.ircname)
-        return self
+
+    def _resolved(self, addresses, error):
+        """[Internal] Called with the resolver's result."""
+        if error is not None:
+            self._connect_failed("Couldn't resolve %s: %s" % (self.server, error))
+            return
+        self._addresses = list(addresses)
+        self._connect_next()
+
+    def _connect_next(self, error=None):
+        """[Internal] Start connecting to the next resolved address."""
+        while self._addresses:
+            family, socktype, proto, canonname, address = self._addresses.pop(0)
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            try:
+                if self.localaddress or self.localport:
+                    sock.bind((self.localaddress, self.localport))
+                err = sock.connect_ex(address)
+            except socket.error, x:
+                err = x.args[0]
+            if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.socket = sock
+                self.irclibobj._add_socket(self, sock)
+                # Writable once connected (or failed).
+                self.irclibobj._watch_write(self, True)
+                return
+            sock.close()
+            error = errno.errorcode.get(err, err)
+        self._connect_failed("Couldn't connect to socket: %s" % error)
+
+    def _connect_ready(self):
+        """[Internal] The connecting socket became writable."""
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._close_socket()
+            self._connect_next(os.strerror(err))
+            return
+        if self.ssl_context is not None:
+            # Hand the socket over to TLS and let the reactor drive
+            # the handshake.
+            raw = self.socket
+            self.irclibobj._remove_socket(self, raw)
+            self._write_watched = False
+            self.socket = self.ssl = self.ssl_context.wrap_socket(
+                raw, server_hostname=self.server, do_handshake_on_connect=False)
+            self.irclibobj._add_socket(self, self.socket)
+            self._handshaking = 1
+            self._continue_handshake()
+            return
+        self._connected()
+
+    def _continue_handshake(self):
+        """[Internal] Take the TLS handshake one step further."""
+        try:
+            self.socket.do_handshake()
+        except _tls.SSLWantReadError:
+            self.irclibobj._watch_write(self, False)
+            return
+        except _tls.SSLWantWriteError:
+            self.irclibobj._watch_write(self, True)
+            return
+        except (socket.error, ValueError), x:
+            # (ssl.CertificateError is a ValueError.)
+            self._connect_failed("TLS handshake failed: %s" % x)
+            return
+        self._handshaking = 0
+        self._connected()
+
+    def _connect_failed(self, reason):
+        """[Internal] Give up a non-blocking connect."""
+        if not self.connecting:
+            return
+        self._abort_connect()
+        self._handle_event(Event("connect_failed", self.server, "", [reason]))
+
+    def _abort_connect(self):
+        """[Internal] Stop a non-blocking connect in progress."""
+        self.connecting = 0
+        self._handshaking = 0
+        self._connect_attempt = self._connect_attempt + 1
+        self._addresses = []
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        self._close_socket()
+
+    def _close_socket(self):
+        """[Internal]"""
+        if self.socket is not None:
+            self.irclibobj._remove_socket(self, self.socket)
+            self._write_watched = False
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+
+    def is_connecting(self):
+        """Return true while a non-blocking connect is in progress."""
+        return self.connecting
 
     def close(self):
         """Close the connection.
@@ -487,61 +1677,81 @@ class ServerConnection(Connection):
 
         return self.real_nickname
 
+    def flush(self):
+        """Write as much of the send buffer as the socket accepts
+        without blocking.
+
+        See Connection.flush.  While connecting, writability means the
+        connect finished.
+        """
+        if self.connecting:
+            if self._handshaking:
+                self._continue_handshake()
+            elif self.socket is not None:
+                self._connect_ready()
+            return 1
+        return Connection.flush(self)
+
     def process_data(self):
         """[Internal]"""
 
+        if self.connecting:
+            if self._handshaking:
+                self._continue_handshake()
+            elif self.socket is not None:
+                # Errors of a connecting socket show up as readable.
+                self._connect_ready()
+            return
         try:
             if self.ssl:
-                new_data = self.ssl.read(2**14)
+                new_data = self._read_tls()
             else:
-                new_data = self.socket.recv(2**14)
+                n = self.socket.recv_into(self.irclibobj.recv_buffer)
+                new_data = self.irclibobj.recv_view[:n]
         except socket.error, x:
+            if x.args[0] in _WOULD_BLOCK or isinstance(x, _TLS_WOULD_BLOCK):
+                return
             # The server hung up.
             self.disconnect("Connection reset by peer")
             return
-        if not new_data:
+        if not len(new_data):
             # Read nothing: connection must be down.
             self.disconnect("Connection reset by peer")
             return
 
-        lines = _linesep_regexp.split(self.previous_buffer + new_data)
+        # Huh!?  Crrrrazy EFNet doesn't follow the RFC: their ircd seems to
+        # use \n as message separator!  :P  LineBuffer handles both.
+        self.buffer.feed(new_data)
 
-        # Save the last, unfinished line.
-        self.previous_buffer = lines.pop()
-
-        for line in lines:
+        wants = self.irclibobj.has_handlers
+        for line in self.buffer.lines():
             if DEBUG:
                 print "FROM SERVER:", line
 
             if not line:
                 continue
 
-            prefix = None
-            command = None
-            arguments = None
-            self._handle_event(Event("all_raw_messages",
-                                     self.get_server_name(),
-                                     None,
-                                     [line]))
-
-            m = _rfc_1459_command_regexp.match(line)
-            if m.group("prefix"):
-                prefix = m.group("prefix")
-                if not self.real_server_name:
-                    self.real_server_name = prefix
-
-            if m.group("command"):
-                command = m.group("command").lower()
-
-            if m.group("argument"):
-                a = m.group("argument").split(" :", 1)
-                arguments = a[0].split()
-                if len(a) == 2:
-                    arguments.append(a[1])
-
-            # Translate numerics into more readable strings.
-            if command in numeric_events:
-                command = numeric_events[command]
+            if wants("all_raw_messages", self):
+                self._handle_event(Event("all_raw_messages",
+                                         self.get_server_name(),
+                                         None,
+                                         [line]))
+
+            # Skip lines nobody listens to before parsing them.  A few
+            # commands update the connection state and are always
+            # parsed, as is everything until the server name is known.
+            command = _peek_command(line)
+            if command is not None and self.real_server_name \
+                   and command not in _state_events:
+                for eventtype in _derived_events.get(command, (command,)):
+                    if wants(eventtype, self):
+                        break
+                else:
+                    continue
+
+            prefix, command, arguments = parse_message(line)
+            if prefix and not self.real_server_name:
+                self.real_server_name = prefix
 
             if command == "nick":
                 if nm_to_n(prefix) == self.real_nickname:
@@ -550,6 +1760,16 @@ class ServerConnection(Connection):
                 # Record the nickname in case the client changed nick
                 # in a nicknameinuse callback.
                 self.real_nickname = arguments[0]
+                # Most servers greet us with our full nick!user@host.
+                words = arguments[-1].split()
+                if words and "!" in words[-1] and "@" in words[-1]:
+                    self.real_userhost = words[-1].split("!", 1)[1]
+            elif command == "join":
+                if prefix and "!" in prefix \
+                       and nm_to_n(prefix) == self.real_nickname:
+                    self.real_userhost = prefix.split("!", 1)[1]
+            elif command == "featurelist":
+                self._parse_isupport(arguments[1:-1])
 
             if command in ["privmsg", "notice"]:
                 target, message = arguments[0], arguments[1]
@@ -575,14 +1795,17 @@ class ServerConnection(Connection):
                         if DEBUG:
                             print "command: %s, source: %s, target: %s, arguments: %s" % (
                                 command, prefix, target, m)
-                        self._handle_event(Event(command, prefix, target, m))
-                        if command == "ctcp" and m[0] == "ACTION":
+                        if wants(command, self):
+                            self._handle_event(Event(command, prefix, target, m))
+                        if command == "ctcp" and m[0] == "ACTION" \
+                               and wants("action", self):
                             self._handle_event(Event("action", prefix, target, m[1:]))
                     else:
                         if DEBUG:
                             print "command: %s, source: %s, target: %s, arguments: %s" % (
                                 command, prefix, target, [m])
-                        self._handle_event(Event(command, prefix, target, [m]))
+                        if wants(command, self):
+                            self._handle_event(Event(command, prefix, target, [m]))
             else:
                 target = None
 
@@ -601,13 +1824,81 @@ class ServerConnection(Connection):
                 if DEBUG:
                     print "command: %s, source: %s, target: %s, arguments: %s" % (
                         command, prefix, target, arguments)
-                self._handle_event(Event(command, prefix, target, arguments))
+                if wants(command, self):
+                    self._handle_event(Event(command, prefix, target, arguments))
+
+    def _read_tls(self):
+        """[Internal] Read everything the TLS connection has decrypted.
+
+        The TLS layer may hold decrypted data the kernel knows nothing
+        about, so the reactor would not report the socket readable
+        again for it; read until it's drained.
+        """
+        data = self.socket.recv(2**14)
+        if not data:
+            return data
+        chunks = [data]
+        try:
+            while self.socket.pending():
+                data = self.socket.recv(2**14)
+                if not data:
+                    break
+                chunks.append(data)
+        except _TLS_WOULD_BLOCK:
+            pass
+        return "".join(chunks)
+
+    def _parse_isupport(self, tokens):
+        """[Internal] Record RPL_ISUPPORT (005) tokens in self.isupport."""
+        for token in tokens:
+            if token[:1] == "-":
+                self.isupport.pop(token[1:].upper(), None)
+            elif "=" in token:
+                key, value = token.split("=", 1)
+                self.isupport[key.upper()] = value
+            else:
+                self.isupport[token.upper()] = ""
+
+    def get_targmax(self, command):
+        """Return how many targets the server accepts for command.
+
+        The value comes from the TARGMAX (or the older MAXTARGETS)
+        token the server announced.  Returns None if there is no
+        limit and 1 if the server didn't say.
+        """
+        targmax = self.isupport.get("TARGMAX")
+        if targmax is not None:
+            for entry in targmax.split(","):
+                name, sep, limit = entry.partition(":")
+                if name.upper() == command.upper():
+                    if not limit:
+                        return None
+                    return max(1, int(limit))
+            return 1
+        maxtargets = self.isupport.get("MAXTARGETS")
+        if maxtargets:
+            return max(1, int(maxtargets))
+        return 1
+
+    def get_prefixes(self):
+        """Return the channel member prefixes of the server.
+
+        The value comes from the PREFIX token the server announced
+        and defaults to operator (@) and voice (+).  Returns a
+        dictionary mapping prefix characters to mode characters.
+        """
+        prefix = self.isupport.get("PREFIX", "(ov)@+")
+        if prefix[:1] != "(" or ")" not in prefix:
+            return {}
+        modes, chars = prefix[1:].split(")", 1)
+        return dict(zip(chars, modes))
 
     def _handle_event(self, event):
         """[Internal]"""
         self.irclibobj._handle_event(self, event)
-        if event.eventtype() in self.handlers:
-            for fn in self.handlers[event.eventtype()]:
+        fns = self.handlers.get(event._eventtype)
+        if fns:
+            for fn in fns:
                 fn(self, event)
 
     def is_connected(self):
@@ -655,13 +1946,24 @@ class ServerConnection(Connection):
 
             message -- Quit message.
         """
+        if self.connecting:
+            self._abort_connect()
+            return
         if not self.connected:
             return
 
         self.connected = 0
 
-        self.quit(message)
+        try:
+            self.quit(message)
+        except SendBufferFullError:
+            pass
+        if self.flood_control is not None:
+            self.flood_control.clear()
+        # Last chance for pending output (including the QUIT).
+        self.flush()
 
+        self.irclibobj._remove_socket(self, self.socket)
         try:
             self.socket.close()
         except socket.error, x:
@@ -737,9 +2039,11 @@ class ServerConnection(Connection):
         self.send_raw("NICK " + newnick)
 
     def notice(self, target, text):
-        """Send a NOTICE command."""
-        # Should limit len(text) here!
-        self.send_raw("NOTICE %s :%s" % (target, text))
+        """Send a NOTICE command.
+
+        Long texts are split into several lines, see send_message.
+        """
+        self.send_message("NOTICE", [target], text)
 
     def oper(self, nick, password):
         """Send an OPER command."""
@@ -765,14 +2069,75 @@ class ServerConnection(Connection):
         self.send_raw("PONG %s%s" % (target, target2 and (" " + target2)))
 
     def privmsg(self, target, text):
-        """Send a PRIVMSG command."""
-        # Should limit len(text) here!
-        self.send_raw("PRIVMSG %s :%s" % (target, text))
+        """Send a PRIVMSG command.
+
+        Long texts are split into several lines, see send_message.
+        """
+        self.send_message("PRIVMSG", [target], text)
 
     def privmsg_many(self, targets, text):
-        """Send a PRIVMSG command to multiple targets."""
-        # Should limit len(text) here!
-        self.send_raw("PRIVMSG %s :%s" % (",".join(targets), text))
+        """Send a PRIVMSG command to multiple targets.
+
+        As many targets as the server allows share one line, see
+        send_message.
+        """
+        self.send_message("PRIVMSG", targets, text)
+
+    def send_message(self, command, targets, text):
+        """Send text to targets with as few lines as possible.
+
+        Arguments:
+
+            command -- "PRIVMSG" or "NOTICE".
+
+            targets -- A list of nicknames and/or channels.
+
+            text -- The text (a string or a unicode object, which is
+                    sent UTF-8 encoded).
+
+        The server relays a line with our nick!user@host prefixed to
+        it, and truncates the relayed line at 512 bytes.  Text that
+        doesn't fit is split into several lines, preferably between
+        words and never within a UTF-8 character.  CTCP messages
+        (text containing \\001) are sent unsplit.
+
+        Targets are grouped into one line up to the TARGMAX the server
+        announced, as long as that doesn't lead to more lines.
+        """
+        if self.socket is None or self.connecting:
+            raise ServerNotConnectedError, "Not connected."
+        if type(text) is types.UnicodeType:
+            text = text.encode("utf-8")
+        targets = list(targets)
+        targmax = self.get_targmax(command)
+        prefix = self._relay_prefix_length()
+        while targets:
+            group = [targets.pop(0)]
+            lines = self._split_for(command, group, text, prefix)
+            while targets and (targmax is None or len(group) < targmax):
+                more = self._split_for(command, group + targets[:1], text, prefix)
+                if len(more) > len(lines):
+                    break
+                group.append(targets.pop(0))
+                lines = more
+            header = "%s %s :" % (command, ",".join(group))
+            for line in lines:
+                self.send_raw(header + line)
+
+    def _relay_prefix_length(self):
+        """[Internal] Length of the ":nick!user@host " prefix the server
+        adds to lines it relays for us."""
+        if self.real_userhost:
+            userhost = len(self.real_userhost)
+        else:
+            # ~user@ plus the longest hostname allowed.
+            userhost = len(self.username) + 2 + 63
+        return len(self.real_nickname) + userhost + 3
+
+    def _split_for(self, command, targets, text, prefix):
+        """[Internal]"""
+        header = len(command) + len(",".join(targets)) + 3
+        return _split_text(text, 510 - prefix - header)
 
     def quit(self, message=""):
         """Send a QUIT command."""
@@ -783,20 +2148,37 @@ class ServerConnection(Connection):
     def send_raw(self, string):
         """Send raw string to the server.
 
-        The string will be padded with appropriate CR LF.
+        The string will be padded with appropriate CR LF.  It is sent
+        without blocking; see Connection for buffering and the
+        SendBufferFullError raised at the high-water mark.
         """
-        if self.socket is None:
+        if self.socket is None or self.connecting:
             raise ServerNotConnectedError, "Not connected."
-        try:
-            if self.ssl:
-                self.ssl.write(string + "\r\n")
-            else:
-                self.socket.send(string + "\r\n")
-            if DEBUG:
-                print "TO SERVER:", string
-        except socket.error, x:
-            # Ouch!
-            self.disconnect("Connection reset by peer.")
+        if self.flood_control is not None:
+            self._schedule(string + "\r\n")
+        else:
+            self._write(string + "\r\n")
+        if DEBUG:
+            print "TO SERVER:", string
+
+    def _schedule(self, data):
+        """[Internal] Hand a line to flood control."""
+        fields = data.split(" ", 2)
+        command = fields[0].upper()
+        target = None
+        if command == "QUIT":
+            # Sent right before hanging up, so it can't wait.
+            self._write(data, 1)
+            return
+        priority = command in _priority_commands
+        if command in ("PRIVMSG", "NOTICE") and len(fields) > 1:
+            target = irc_lower(fields[1])
+            priority = fields[1].upper() in _priority_targets
+        if not priority:
+            pending = self.flood_control.queued_bytes + len(self.send_buffer)
+            if pending + len(data) > self.send_buffer_limit:
+                raise SendBufferFullError, "Send buffer full."
+        self.flood_control.enqueue(data, target, priority)
 
     def squit(self, server, comment=""):
         """Send an SQUIT command."""
@@ -864,11 +2246,18 @@ class DCCConnection(Connection):
     DCCConnection objects are instantiated by calling the dcc
     method on an IRC object.
     """
-    def __init__(self, irclibobj, dcctype):
+
+    # Longest unfinished line (in bytes) a DCC CHAT peer may send before
+    # the connection is dropped.
+    max_line_length = 2**14
+
+    def __init__(self, irclibobj, dcctype, max_line_length=None):
         Connection.__init__(self, irclibobj)
         self.connected = 0
         self.passive = 0
         self.dcctype = dcctype
+        if max_line_length is not None:
+            self.max_line_length = max_line_length
         self.peeraddress = None
         self.peerport = None
 
@@ -882,23 +2271,44 @@ class DCCConnection(Connection):
 
         Returns the DCCConnection object.
         """
-        self.peeraddress = socket.gethostbyname(address)
-        self.peerport = port
-        self.socket = None
-        self.previous_buffer = ""
-        self.handlers = {}
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.passive = 0
+        address = socket.gethostbyname(address)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.socket.connect((self.peeraddress, self.peerport))
-
+            sock.connect((address, port))
         except socket.error, x:
+            sock.close()
             raise DCCConnectionError, "Couldn't connect to socket: %s" % x
+        return self.adopt(sock, address, port)
+
+    def adopt(self, sock, address, port):
+        """Use a socket that is already connected to a DCC peer.
 
+        Since connect blocks until the peer answers, the socket may be
+        connected by another thread and handed over with adopt.  adopt
+        must be called from the thread running the IRC object, see
+        IRC.call_soon_threadsafe.
+
+        Arguments:
+            sock -- The connected socket.
+
+            address -- IP address of the peer.
+
+            port -- The port number of the peer.
+
+        Returns the DCCConnection object.
+        """
+        self.peeraddress = address
+        self.peerport = port
+        self.socket = sock
+        self.buffer = LineBuffer()
+        self.handlers = {}
+        self.passive = 0
+        self.socket.setblocking(0)
+        del self.send_buffer[:]
+        self._write_watched = False
         self.connected = 1
 
-        if self.irclibobj.fn_to_add_socket:
-            self.irclibobj.fn_to_add_socket(self.socket)
+        self.irclibobj._add_socket(self, self.socket)
 
         return self
 
@@ -912,7 +2322,7 @@ class DCCConnection(Connection):
         peer, the peer address and port are available as
         self.peeraddress and self.peerport.
         """
-        self.previous_buffer = ""
+        self.buffer = LineBuffer()
         self.handlers = {}
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.passive = 1
@@ -922,6 +2332,9 @@ class DCCConnection(Connection):
             self.socket.listen(10)
         except socket.error, x:
             raise DCCConnectionError, "Couldn't bind socket: %s" % x
+
+        self.irclibobj._add_socket(self, self.socket)
+
         return self
 
     def disconnect(self, message=""):
@@ -931,10 +2344,16 @@ class DCCConnection(Connection):
 
             message -- Quit message.
         """
-        if not self.connected:
+        if self.socket is None:
             return
 
         self.connected = 0
+        # Last chance for pending output.
+        self.flush()
+        if self.socket is None:
+            # The flush failed and disconnected already.
+            return
+        self.irclibobj._remove_socket(self, self.socket)
         try:
             self.socket.close()
         except socket.error, x:
@@ -950,8 +2369,12 @@ class DCCConnection(Connection):
 
         if self.passive and not self.connected:
             conn, (self.peeraddress, self.peerport) = self.socket.accept()
+            self.irclibobj._remove_socket(self, self.socket)
             self.socket.close()
             self.socket = conn
+            self.socket.setblocking(0)
+            self._write_watched = False
+            self.irclibobj._add_socket(self, self.socket)
             self.connected = 1
             if DEBUG:
                 print "DCC connection from %s:%d" % (
@@ -962,12 +2385,14 @@ class DCCConnection(Connection):
             return
 
         try:
-            new_data = self.socket.recv(2**14)
+            n = self.socket.recv_into(self.irclibobj.recv_buffer)
         except socket.error, x:
+            if x.args[0] in _WOULD_BLOCK:
+                return
             # The server hung up.
             self.disconnect("Connection reset by peer")
             return
-        if not new_data:
+        if not n:
             # Read nothing: connection must be down.
             self.disconnect("Connection reset by peer")
             return
@@ -975,19 +2400,20 @@ class DCCConnection(Connection):
         if self.dcctype == "chat":
             # The specification says lines are terminated with LF, but
             # it seems safer to handle CR LF terminations too.
-            chunks = _linesep_regexp.split(self.previous_buffer + new_data)
+            self.buffer.feed(self.irclibobj.recv_view[:n])
+            chunks = self.buffer.lines()
 
-            # Save the last, unfinished line.
-            self.previous_buffer = chunks[-1]
-            if len(self.previous_buffer) > 2**14:
+            # Only the last, unfinished line is left in the buffer.
+            if len(self.buffer) > self.max_line_length:
                 # Bad peer! Naughty peer!
                 self.disconnect()
                 return
-            chunks = chunks[:-1]
         else:
-            chunks = [new_data]
+            chunks = [self.irclibobj.recv_view[:n].tobytes()]
 
         command = "dccmsg"
+        if not self.irclibobj.has_handlers(command):
+            return
         prefix = self.peeraddress
         target = None
         for chunk in chunks:
@@ -1009,17 +2435,207 @@ class DCCConnection(Connection):
         """Send data to DCC peer.
 
         The string will be padded with appropriate LF if it's a DCC
-        CHAT session.
+        CHAT session.  It is sent without blocking; see Connection for
+        buffering and the SendBufferFullError raised at the high-water
+        mark.
         """
+        if self.dcctype == "chat":
+            self._write(string + "\n")
+        else:
+            self._write(string)
+        if DEBUG:
+            print "TO PEER: %s\n" % string
+
+class DCCSendConnection(DCCConnection):
+    """A DCC SEND file transfer, seen from the sending side.
+
+    DCCSendConnection objects are instantiated by calling the dcc_send
+    method on an IRC object, and the file is offered to the peer with
+    SimpleIRCClient.dcc_send.  Once the peer has connected, the file
+    is sent as fast as the socket (and the optional rate limit)
+    allows, with os.sendfile where the platform has it so that the
+    data never passes through Python.  The peer acknowledges the
+    received bytes; when everything has been acknowledged, the
+    connection is closed.
+
+    The transfer ends with a "dcc_disconnect" event like any DCC
+    connection; the complete attribute tells whether the whole file
+    was sent.
+    """
+
+    # Most bytes handed to the socket at once.
+    chunk_size = 2**16
+
+    # Seconds the peer has to connect after listen.
+    accept_timeout = 120
+
+    def __init__(self, irclibobj, path, rate=None):
+        DCCConnection.__init__(self, irclibobj, "send")
         try:
-            self.socket.send(string)
-            if self.dcctype == "chat":
-                self.socket.send("\n")
-            if DEBUG:
-                print "TO PEER: %s\n" % string
+            self.file = open(path, "rb")
+        except IOError, x:
+            raise DCCConnectionError, "Couldn't open file: %s" % x
+        self.path = path
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.offset = 0  # Where the transfer starts, see resume.
+        self.position = 0  # Bytes of the file handed to the socket.
+        self.acked = 0  # The peer's last acknowledgement.
+        self.complete = 0
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate, max(1024, min(rate, self.chunk_size)))
+        self._timer = None
+        # Acknowledgements are 32 bit counters, possibly split
+        # between reads.
+        self._acks = bytearray(4096)
+        self._acks_view = memoryview(self._acks)
+        self._acks_left = 0
+        if not hasattr(os, "sendfile"):
+            self._chunk = bytearray(self.chunk_size)
+            self._chunk_view = memoryview(self._chunk)
+            self._chunk_start = self._chunk_end = 0
+
+    def resume(self, position):
+        """Start the transfer at position instead of at the beginning
+        of the file (DCC RESUME).
+
+        Returns true if that is possible, which it is not once the
+        peer has connected.
+        """
+        if self.connected or not 0 <= position <= self.size:
+            return 0
+        self.offset = self.position = position
+        return 1
+
+    def listen(self):
+        """Wait for the peer to connect.
+
+        See DCCConnection.listen.  If the peer doesn't connect within
+        accept_timeout seconds, the connection is closed.
+        """
+        DCCConnection.listen(self)
+        self._timer = self.irclibobj.execute_delayed(self.accept_timeout,
+                                                     self._accept_timed_out)
+        return self
+
+    def disconnect(self, message=""):
+        """Stop the transfer and close the connection.
+
+        See DCCConnection.disconnect.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.file.close()
+        DCCConnection.disconnect(self, message)
+
+    def process_data(self):
+        """[Internal]"""
+        if self.passive and not self.connected:
+            DCCConnection.process_data(self)
+            if self.connected:
+                self._timer.cancel()
+                self._timer = None
+                self.flush()
+            return
+
+        left = self._acks_left
+        try:
+            n = self.socket.recv_into(self._acks_view[left:])
         except socket.error, x:
-            # Ouch!
-            self.disconnect("Connection reset by peer.")
+            if x.args[0] in _WOULD_BLOCK:
+                return
+            self.disconnect("Connection reset by peer")
+            return
+        if not n:
+            if self.position == self.size:
+                self.complete = 1
+                self.disconnect("Transfer complete")
+            else:
+                self.disconnect("Connection reset by peer")
+            return
+
+        # Only the last complete acknowledgement matters.
+        total = left + n
+        end = total - total % 4
+        if end:
+            self.acked = struct.unpack_from("!I", self._acks, end - 4)[0]
+        self._acks_left = total - end
+        if self._acks_left:
+            self._acks[:self._acks_left] = self._acks[end:total]
+
+        # Peers count from the start of the file or of the transfer.
+        if self.position == self.size \
+               and self.acked in (self.size & 0xffffffffL,
+                                  (self.size - self.offset) & 0xffffffffL):
+            self.complete = 1
+            self.disconnect("Transfer complete")
+
+    def flush(self):
+        """Send as much of the file as the socket and the rate limit
+        allow without blocking.
+
+        Returns true if the whole file has been sent.
+        """
+        if not self.connected:
+            return self.position == self.size
+        now = monotonic()
+        while self.position < self.size:
+            count = min(self.chunk_size, self.size - self.position)
+            if self.bucket is not None:
+                count = min(count, int(self.bucket.burst))
+                wait = self.bucket.delay(count, now)
+                if wait:
+                    self.irclibobj._watch_write(self, False)
+                    if self._timer is None:
+                        self._timer = self.irclibobj.execute_delayed(
+                            wait, self._rate_timer)
+                    return 0
+            try:
+                n = self._send(count)
+            except (socket.error, IOError, OSError), x:
+                if x.args[0] in _WOULD_BLOCK:
+                    self.irclibobj._watch_write(self, True)
+                    return 0
+                self.disconnect("Connection reset by peer")
+                return 0
+            if not n:
+                self.disconnect("File truncated")
+                return 0
+            self.position = self.position + n
+            if self.bucket is not None:
+                self.bucket.consume(n)
+        self.irclibobj._watch_write(self, False)
+        return 1
+
+    def _send(self, count):
+        """[Internal] Send up to count bytes of the file from
+        self.position on.  Returns the number of bytes sent."""
+        if hasattr(os, "sendfile"):
+            return os.sendfile(self.socket.fileno(), self.file.fileno(),
+                               self.position, count)
+        # Without sendfile, read into a reused buffer and send from it.
+        if self._chunk_start == self._chunk_end:
+            self.file.seek(self.position)
+            self._chunk_start = 0
+            self._chunk_end = self.file.readinto(self._chunk_view[:count])
+            if not self._chunk_end:
+                return 0
+        end = min(self._chunk_end, self._chunk_start + count)
+        n = self.socket.send(self._chunk_view[self._chunk_start:end])
+        self._chunk_start = self._chunk_start + n
+        return n
+
+    def _accept_timed_out(self):
+        """[Internal]"""
+        self._timer = None
+        if not self.connected:
+            self.disconnect("Peer didn't connect")
+
+    def _rate_timer(self):
+        """[Internal]"""
+        self._timer = None
+        self.flush()
 
 class SimpleIRCClient:
     """A simple single-server IRC client class.
@@ -1032,7 +2648,10 @@ class SimpleIRCClient:
     (which is done when the server sends a JOIN messsage/command),
     on_privmsg will be called for "privmsg" events, and so on.  The
     handler methods get two arguments: the connection object (same as
-    self.connection) and the event object.
+    self.connection) and the event object.  The handler methods are
+    looked up once when the object is constructed and registered as
+    global handlers for their event types; events without a handler
+    method are not even parsed.
 
     Instance attributes that can be used by sub classes:
 
@@ -1041,25 +2660,65 @@ class SimpleIRCClient:
         connection -- The ServerConnection instance.
 
         dcc_connections -- A list of DCCConnection instances.
+
+        dcc_lock -- A lock to hold while using dcc_connections, which
+                    the threads of dcc_shards change too.
+
+        dcc_shards -- A list of the IRC instances started by
+                      start_dcc_shards.
+
+        max_dcc_sends -- The most DCC SEND transfers dcc_send runs at
+                         the same time.
+
+        event_methods -- A dictionary mapping event types to the
+                         bound on_* methods handling them.
     """
+
+    max_dcc_sends = 4
+
     def __init__(self):
         self.ircobj = IRC()
         self.connection = self.ircobj.server()
         self.dcc_connections = []
-        self.ircobj.add_global_handler("all_events", self._dispatcher, -10)
+        self.dcc_lock = threading.Lock()
+        self.dcc_shards = []
+        self._dcc_threads = []
+        self.event_methods = {}
+        for name in dir(self):
+            if name.startswith("on_"):
+                method = getattr(self, name)
+                if callable(method):
+                    self.event_methods[name[3:]] = method
+        for eventtype, method in self.event_methods.items():
+            self.ircobj.add_global_handler(eventtype, method, -10)
         self.ircobj.add_global_handler("dcc_disconnect", self._dcc_disconnect, -10)
 
-    def _dispatcher(self, c, e):
+    def _dcc_disconnect(self, c, e):
+        self.dcc_lock.acquire()
+        try:
+            self.dcc_connections.remove(c)
+        finally:
+            self.dcc_lock.release()
+
+    def _add_dcc(self, dcc):
         """[Internal]"""
-        m = "on_" + e.eventtype()
-        if hasattr(self, m):
-            getattr(self, m)(c, e)
+        self.dcc_lock.acquire()
+        try:
+            self.dcc_connections.append(dcc)
+        finally:
+            self.dcc_lock.release()
 
-    def _dcc_disconnect(self, c, e):
-        self.dcc_connections.remove(c)
+    def _dcc_connections(self):
+        """[Internal] Returns a copy of dcc_connections."""
+        self.dcc_lock.acquire()
+        try:
+            return self.dcc_connections[:]
+        finally:
+            self.dcc_lock.release()
 
     def connect(self, server, port, nickname, password=None, username=None,
-                ircname=None, localaddress="", localport=0, ssl=False, ipv6=False):
+                ircname=None, localaddress="", localport=0, ssl=False, ipv6=False,
+                nonblocking=False, timeout=30):
         """Connect/reconnect to a server.
 
         Arguments:
@@ -1080,15 +2739,21 @@ class SimpleIRCClient:
 
             localport -- Bind the connection to a specific local port.
 
-            ssl -- Enable support for ssl.
+            ssl -- Use TLS (true or an ssl.SSLContext).
 
             ipv6 -- Enable support for ipv6.
 
+            nonblocking -- Connect in the background.
+
+            timeout -- Seconds a non-blocking connect may take.
+
         This function can be called to reconnect a closed connection.
+        See ServerConnection.connect.
         """
         self.connection.connect(server, port, nickname,
                                 password, username, ircname,
-                                localaddress, localport, ssl, ipv6)
+                                localaddress, localport, ssl, ipv6,
+                                nonblocking, timeout)
 
     def dcc_connect(self, address, port, dcctype="chat"):
         """Connect to a DCC peer.
@@ -1103,20 +2768,162 @@ class SimpleIRCClient:
         """
 
         dcc = self.ircobj.dcc(dcctype)
-        self.dcc_connections.append(dcc)
+        self._add_dcc(dcc)
         dcc.connect(address, port)
         return dcc
 
+    def dcc_adopt(self, sock, address, port, dcctype="chat"):
+        """Use a socket connected to a DCC peer by another thread.
+
+        The connection is served by dcc_ircobj(address), and dcc_adopt
+        must be called from the thread running it.
+
+        Arguments:
+
+            sock -- The connected socket.
+
+            address -- IP address of the peer.
+
+            port -- Port of the peer.
+
+        Returns a DCCConnection instance.  See DCCConnection.adopt.
+        """
+        dcc = self.dcc_ircobj(address).dcc(dcctype)
+        self._add_dcc(dcc)
+        dcc.adopt(sock, address, port)
+        return dcc
+
+    def start_dcc_shards(self, count):
+        """Serve the DCC connections created by dcc_adopt on count IRC
+        objects of their own, each running in a thread of its own.
+
+        Peers are assigned to the shards by address, see dcc_ircobj.
+        The handler methods are called in the thread of the shard
+        serving the connection, so a burst of DCC traffic doesn't
+        delay the server connection (and the answers to PING).  For
+        the same reason, handlers called by a shard must not use
+        self.connection directly but hand the calls over with
+        self.ircobj.call_soon_threadsafe.
+        """
+        for i in range(count):
+            ircobj = IRC()
+            for eventtype, method in self.event_methods.items():
+                ircobj.add_global_handler(eventtype, method, -10)
+            ircobj.add_global_handler("dcc_disconnect", self._dcc_disconnect, -10)
+            self.dcc_shards.append(ircobj)
+            thread = threading.Thread(target=ircobj.process_forever,
+                                      name="DCC shard %d" % len(self.dcc_shards))
+            thread.setDaemon(1)
+            thread.start()
+            self._dcc_threads.append(thread)
+
+    def stop_dcc_shards(self, message=""):
+        """Close the DCC connections of the shards started by
+        start_dcc_shards and wait for their threads to end.
+
+        Arguments:
+
+            message -- Quit message.
+
+        Afterwards, dcc_shards is empty and new DCC connections are
+        served by ircobj.
+        """
+        for ircobj in self.dcc_shards:
+            ircobj.call_soon_threadsafe(self._stop_dcc_shard, (ircobj, message))
+        for thread in self._dcc_threads:
+            if thread is not threading.currentThread():
+                thread.join()
+        self.dcc_shards = []
+        self._dcc_threads = []
+
+    def _stop_dcc_shard(self, ircobj, message):
+        """[Internal]"""
+        ircobj.disconnect_all(message)
+        ircobj.stop()
+
+    def dcc_ircobj(self, address):
+        """Returns the IRC object serving DCC connections with the peer
+        at address: one of dcc_shards, or ircobj if there are none.
+        """
+        if not self.dcc_shards:
+            return self.ircobj
+        return self.dcc_shards[hash(address) % len(self.dcc_shards)]
+
     def dcc_listen(self, dcctype="chat"):
         """Listen for connections from a DCC peer.
 
         Returns a DCCConnection instance.
         """
         dcc = self.ircobj.dcc(dcctype)
-        self.dcc_connections.append(dcc)
+        self._add_dcc(dcc)
+        dcc.listen()
+        return dcc
+
+    def dcc_send(self, nick, path, rate=None, filename=None):
+        """Offer a file to a user with DCC SEND.
+
+        Arguments:
+
+            nick -- The user to send the file to.
+
+            path -- Path of the file.
+
+            rate -- Maximum number of bytes per second to send, or
+                    None for no limit.
+
+            filename -- File name shown to the user.  Defaults to the
+                        base name of path.
+
+        Raises DCCConnectionError if max_dcc_sends transfers are
+        running already or if the file can't be opened.  If the offer
+        can't be sent (for example ServerNotConnectedError), the
+        transfer is closed again and the error is raised.
+
+        Returns a DCCSendConnection instance.
+        """
+        sends = [c for c in self._dcc_connections() if isinstance(c, DCCSendConnection)]
+        if len(sends) >= self.max_dcc_sends:
+            raise DCCConnectionError, "Too many DCC SEND transfers."
+        dcc = self.ircobj.dcc_send(path, rate)
+        dcc.nick = nick
+        dcc.filename = (filename or os.path.basename(path)).replace(" ", "_")
+        self._add_dcc(dcc)
         dcc.listen()
+        try:
+            self.connection.ctcp("DCC", nick, "SEND %s %s %d %d" % (
+                dcc.filename, ip_quad_to_numstr(dcc.localaddress),
+                dcc.localport, dcc.size))
+        except IRCError:
+            # Nobody connects to an offer that wasn't sent.
+            dcc.disconnect()
+            raise
         return dcc
 
+    def dcc_resume(self, nick, filename, port, position):
+        """Answer a DCC RESUME request of a user.
+
+        Arguments:
+
+            nick -- The user asking.
+
+            filename -- File name given by the user.
+
+            port -- Port of the offered transfer.
+
+            position -- Where the user wants the transfer to start.
+
+        Returns true if the transfer offered by dcc_send on port will
+        start at position.
+        """
+        for dcc in self._dcc_connections():
+            if isinstance(dcc, DCCSendConnection) and dcc.localport == port \
+                   and irc_lower(dcc.nick) == irc_lower(nick):
+                if dcc.resume(position):
+                    self.connection.ctcp("DCC", nick, "ACCEPT %s %d %d" % (
+                        filename, port, position))
+                    return 1
+        return 0
+
     def start(self):
         """Start the IRC client."""
         self.ircobj.process_forever()
@@ -1177,17 +2984,285 @@ _low_level_regexp = re.compile(_LOW_LEVEL_QUOTE + "(.)")
 def mask_matches(nick, mask):
     """Check if a nick matches a mask.
 
+    The mask may contain the wildcards * and ?, and must match the
+    whole nick (or nick!user@host).  The compiled masks of recent
+    calls are cached; see MaskSet for testing against many masks.
+
     Returns true if the nick matches, otherwise false.
     """
-    nick = irc_lower(nick)
-    mask = irc_lower(mask)
-    mask = mask.replace("\\", "\\\\")
-    for ch in ".$|[](){}+":
-        mask = mask.replace(ch, "\\" + ch)
-    mask = mask.replace("?", ".")
-    mask = mask.replace("*", ".*")
-    r = re.compile(mask, re.IGNORECASE)
-    return r.match(nick)
+    return _compile_mask(irc_lower(mask)).match(irc_lower(nick))
+
+_mask_cache_size = 1024
+_mask_cache = collections.OrderedDict()
+_mask_cache_lock = threading.Lock()
+
+def _compile_mask(mask):
+    """[Internal] Returns the compiled regular expression of a
+    lowercased mask, from the cache of recently used masks if
+    possible."""
+    _mask_cache_lock.acquire()
+    try:
+        try:
+            r = _mask_cache.pop(mask)
+        except KeyError:
+            r = re.compile(_mask_pattern(mask), re.DOTALL)
+            if len(_mask_cache) >= _mask_cache_size:
+                _mask_cache.popitem(0)
+        _mask_cache[mask] = r
+        return r
+    finally:
+        _mask_cache_lock.release()
+
+def _mask_pattern(mask):
+    """[Internal] Translates a mask into a regular expression."""
+    pattern = re.escape(mask).replace("\\?", ".").replace("\\*", ".*")
+    return pattern + "\\Z"
+
+class MaskSet:
+    """A set of masks to test a nick (or nick!user@host) against at
+    once, e.g. an ignore or ban list.
+
+    Masks without wildcards are looked up in a dictionary.  The other
+    masks are indexed by the literal text before their first or after
+    their last wildcard, whichever is longer, so only the masks whose
+    literal part fits are tried.  Masks that start and end with a
+    wildcard are always tried.  Masks are compared after irc_lower,
+    like in mask_matches.
+    """
+
+    def __init__(self, masks=()):
+        self._masks = {}  # Lowercased mask -> mask as added.
+        self._literals = {}
+        self._prefixes = {}  # Literal prefix -> {lowercased mask: regexp}
+        self._suffixes = {}  # Literal suffix -> {lowercased mask: regexp}
+        self._prefix_lengths = {}  # Length -> number of prefixes.
+        self._suffix_lengths = {}
+        self._rest = {}
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __iter__(self):
+        return iter(self._masks.values())
+
+    def __contains__(self, mask):
+        return irc_lower(mask) in self._masks
+
+    def add(self, mask):
+        """Add a mask to the set."""
+        key = irc_lower(mask)
+        if key in self._masks:
+            return
+        self._masks[key] = mask
+        index, lengths, literal = self._index(key)
+        if index is None:
+            self._literals[key] = mask
+        elif lengths is None:
+            self._rest[key] = re.compile(_mask_pattern(key), re.DOTALL)
+        else:
+            if literal not in index:
+                index[literal] = {}
+                lengths[len(literal)] = lengths.get(len(literal), 0) + 1
+            index[literal][key] = re.compile(_mask_pattern(key), re.DOTALL)
+
+    def remove(self, mask):
+        """Remove a mask from the set.
+
+        Raises KeyError if the mask is not in the set.
+        """
+        key = irc_lower(mask)
+        del self._masks[key]
+        index, lengths, literal = self._index(key)
+        if index is None:
+            del self._literals[key]
+        elif lengths is None:
+            del self._rest[key]
+        else:
+            bucket = index[literal]
+            del bucket[key]
+            if not bucket:
+                del index[literal]
+                lengths[len(literal)] = lengths[len(literal)] - 1
+                if not lengths[len(literal)]:
+                    del lengths[len(literal)]
+
+    def match(self, nick):
+        """Returns a mask matching nick, or None."""
+        for mask in self._matches(irc_lower(nick)):
+            return mask
+        return None
+
+    def matches(self, nick):
+        """Returns a list of all masks matching nick."""
+        return list(self._matches(irc_lower(nick)))
+
+    def _matches(self, nick):
+        """[Internal] Generates the masks matching a lowercased nick."""
+        if nick in self._literals:
+            yield self._literals[nick]
+        # Slicing with a length beyond the nick would look up the
+        # whole nick again under every such length.
+        size = len(nick)
+        for length in self._prefix_lengths:
+            if length > size:
+                continue
+            for mask in self._bucket_matches(self._prefixes.get(nick[:length]), nick):
+                yield mask
+        for length in self._suffix_lengths:
+            if length > size:
+                continue
+            for mask in self._bucket_matches(self._suffixes.get(nick[-length:]), nick):
+                yield mask
+        for mask in self._bucket_matches(self._rest, nick):
+            yield mask
+
+    def _bucket_matches(self, bucket, nick):
+        """[Internal]"""
+        if bucket:
+            for key, r in bucket.iteritems():
+                if r.match(nick):
+                    yield self._masks[key]
+
+    def _index(self, key):
+        """[Internal] Returns the index, the lengths table and the
+        literal part a lowercased mask is stored under.  The index is
+        None for masks without wildcards, the lengths table is None
+        for masks without literal prefix or suffix."""
+        wildcards = [i for i in range(len(key)) if key[i] in "*?"]
+        if not wildcards:
+            return None, None, key
+        prefix = key[:wildcards[0]]
+        suffix = key[wildcards[-1] + 1:]
+        if prefix and len(prefix) >= len(suffix):
+            return self._prefixes, self._prefix_lengths, prefix
+        if suffix:
+            return self._suffixes, self._suffix_lengths, suffix
+        return self._rest, None, None
+
+def parse_message(line):
+    """Parse a raw line from an IRC server.
+
+    The line is split in a single pass, without regular expressions.
+    The function returns a tuple (prefix, command, arguments).  prefix
+    is None if the line has no prefix.  command is the event type of
+    the command, i.e. lowercased and with numerics translated into
+    readable strings (see numeric_events).  arguments is a list of
+    the parameters, with the trailing parameter (the part after
+    \" :\") as last element, or None if there are no parameters.
+
+    Example:
+
+    >>> irclib.parse_message(\":irc.some.where 001 nick :Welcome!\")
+    ('irc.some.where', 'welcome', ['nick', 'Welcome!'])
+    """
+    prefix = None
+    start = 0
+    length = len(line)
+    if line[:1] == ":":
+        i = line.find(" ")
+        if i > 1:
+            j = i + 1
+            while j < length and line[j] == " ":
+                j = j + 1
+            if j < length:
+                prefix = line[1:i]
+                start = j
+
+    i = line.find(" ", start)
+    if i == -1:
+        command = line[start:]
+        rest = ""
+    else:
+        command = line[start:i]
+        rest = line[i:]
+
+    if command:
+        event = _command_events.get(command)
+        if event is None:
+            event = _command_event(command)
+    else:
+        event = None
+
+    arguments = None
+    if len(rest) > 1:
+        rest = rest.lstrip(" ")
+        if not rest:
+            arguments = []
+        elif rest[0] == ":":
+            arguments = [rest[1:]]
+        else:
+            i = rest.find(" :")
+            if i == -1:
+                arguments = rest.split()
+            else:
+                arguments = rest[:i].split()
+                arguments.append(rest[i+2:])
+
+    return prefix, event, arguments
+
+def _split_text(text, limit):
+    """[Internal] Split a UTF-8 string into pieces of at most limit
+    bytes, preferably at spaces.  CTCP messages are never split."""
+    if len(text) <= limit or "\001" in text:
+        return [text]
+    limit = max(limit, 8)
+    pieces = []
+    while len(text) > limit:
+        end = text.rfind(" ", 0, limit + 1)
+        if end > 0:
+            pieces.append(text[:end])
+            text = text[end+1:]
+            continue
+        # No space: cut the word, but not within a UTF-8 sequence.
+        end = limit
+        while end > 0 and "\x80" <= text[end] <= "\xbf":
+            end = end - 1
+        if end == 0:
+            end = limit
+        pieces.append(text[:end])
+        text = text[end:]
+    pieces.append(text)
+    return pieces
+
+def _peek_command(line):
+    """[Internal] Returns the event type of a raw line without parsing
+    the whole line, or None if the line needs a full parse_message."""
+    start = 0
+    if line[0] == ":":
+        start = line.find(" ") + 1
+        if start < 3 or line[start:start+1] in (" ", ""):
+            # Odd spacing; let parse_message sort it out.
+            return None
+    end = line.find(" ", start)
+    if end == -1:
+        command = line[start:]
+    else:
+        command = line[start:end]
+    if not command:
+        return None
+    return _command_events.get(command) or _command_event(command)
+
+# Event types a server command may be dispatched as.
+_derived_events = {
+    "privmsg": ("privmsg", "pubmsg", "ctcp", "action"),
+    "notice": ("privnotice", "pubnotice", "ctcpreply"),
+    "mode": ("mode", "umode"),
+}
+
+# Commands ServerConnection.process_data needs to see even if nobody
+# handles them.
+_state_events = frozenset(["nick", "welcome", "join", "featurelist"])
+
+def _command_event(command):
+    """[Internal] Translate a raw command into an (interned) event type."""
+    event = command.lower()
+    event = intern(numeric_events.get(event, event))
+    # Don't let a misbehaving server grow the table without bounds.
+    if len(_command_events) < 1024:
+        _command_events[command] = event
+    return event
 
 _special = "-[]\\`^{}"
 nick_characters = string.ascii_letters + string.digits + _special
@@ -1326,12 +3401,15 @@ def parse_nick_modes(mode_string):
 
     return _parse_modes(mode_string, "")
 
-def parse_channel_modes(mode_string):
+def parse_channel_modes(mode_string, argument_modes=""):
     """Parse a channel mode string.
 
     The function returns a list of lists with three members: sign,
     mode and argument.  The sign is \"+\" or \"-\".  The argument is
-    None if mode isn't one of \"b\", \"k\", \"l\", \"v\" or \"o\".
+    None if mode isn't one of \"b\", \"k\", \"l\", \"v\" or \"o\" or
+    of argument_modes, the other modes taking an argument on the
+    server (for example the modes of its PREFIX, see
+    ServerConnection.get_prefixes).
 
     Example:
 
@@ -1339,7 +3417,7 @@ def parse_channel_modes(mode_string):
     [['+', 'a', None], ['+', 'b', 'foo'], ['-', 'c', None]]
     """
 
-    return _parse_modes(mode_string, "bklvo")
+    return _parse_modes(mode_string, "bklvo" + argument_modes)
 
 def _parse_modes(mode_string, unary_modes=""):
     """[Internal]"""
@@ -1374,7 +3452,11 @@ def _parse_modes(mode_string, unary_modes=""):
 
 def _ping_ponger(connection, event):
     """[Internal]"""
-    connection.pong(event.target())
+    try:
+        connection.pong(event.target())
+    except SendBufferFullError:
+        # The server is not reading anyway.
+        pass
 
 # Numeric table mostly stolen from the Perl IRC module (Net::IRC).
 numeric_events = {
@@ -1544,7 +3626,10 @@ generated_events = [
     "dcc_disconnect",
     "dccmsg",
     "disconnect",
+    "connect_failed",
     "ctcp",
+    "netsplit",
+    "netjoin",
     "ctcpreply",
 ]
 
@@ -1566,3 +3651,12 @@ protocol_events = [
 ]
 
 all_events = generated_events + protocol_events + numeric_events.values()
+
+# Raw command -> event type cache used by parse_message, precomputed
+# for numerics and the common protocol commands.
+_command_events = {}
+for _command in numeric_events.keys() + [
+        "ERROR", "INVITE", "JOIN", "KICK", "MODE", "NICK", "NOTICE",
+        "PART", "PING", "PONG", "PRIVMSG", "QUIT", "TOPIC", "WALLOPS"]:
+    _command_event(_command)
+del _command
@@ -19,7 +19,11 @@ The base class mcxPyBot and the __main__ programm.
 
 # irc libs
 from datetime import datetime
+from os.path import isfile
+from os.path import join
+from os.path import realpath
 from random import randint
+from threading import Lock
 from threading import Thread
 from time import time
 
@@ -27,6 +31,7 @@ from ircbot import SingleServerIRCBot
 from irclib import DCCConnection
 from irclib import DCCConnectionError
 from irclib import ServerConnection
+from irclib import ServerConnectionError
 from irclib import ip_numstr_to_quad
 from irclib import irc_lower
 from irclib import is_channel
@@ -37,16 +42,15 @@ from mcxPersistentConstants import DATABASE_NAME
 from mcxPersistentConstants import DATABASE_PASS
 from mcxPersistentConstants import DATABASE_USER
 from mcxPersistentExceptions import *
-#from mcxPyBotConnectionPooler import DCCQueue
-#from mcxPyBotConnectionPooler import mcxPyBotConnectionPooler
-#from mcxPyBotConnectionPoolerConstants import *
+from mcxPyBotConnectionPooler import mcxPyBotConnectionPooler
+from mcxPyBotConnectionPoolerConstants import *
 from mcxPyBotConstants import *
 from mcxPyBotEvents import *
 from mcxPyBotExceptions import *
 from mcxPyBotThreads import mcxCheckUpdatesThread
 from mcxPyBotThreads import mcxPyBotThread
 from mcxPyBotThreads import mcxRecoverDBThread
-from mcxPyBotThreads import mcxMessageBridgeThread
+from mcxPyBotThreads import mcxMessageBridge
 
 class mcxPyBot(SingleServerIRCBot):
     """
@@ -81,8 +85,12 @@ class mcxPyBot(SingleServerIRCBot):
         # IRC connection
         SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname)
 
-        # register event handler for all events
-        self.ircobj.add_global_handler('all_events', getattr(self, 'on_event'), -10)
+        # limit the file transfers served at the same time
+        self.max_dcc_sends = CONFIG_DCC_SEND_MAX_TRANSFERS
+
+        # keep the server from kicking the bot for flooding
+        self.connection.set_rate_limit(CONFIG_FLOOD_LINES_PER_SECOND, CONFIG_FLOOD_BYTES_PER_SECOND,
+                                       CONFIG_FLOOD_BURST_LINES, CONFIG_FLOOD_BURST_BYTES)
 
         self.channel = channel
         """The channel in which the bot will serve."""
@@ -90,8 +98,16 @@ class mcxPyBot(SingleServerIRCBot):
         self.__password = password
         """The password used to identify with nick services."""
 
+        self.__connectionPool = mcxPyBotConnectionPooler(self.ircobj, self.__dccConnected)
+        """Connects to DCC chats offered by users without blocking the bot."""
+
+        self.start_dcc_shards(CONFIG_DCC_SHARDS)
+
         self.__IpToUser = {}
-        """A dict which stores IP (dcc) to user (mcx.user.id) relations."""
+        """A dict of the IRC objects serving DCC chats, each to a dict which stores IP (dcc) to user (mcx.user.id) relations of its chats."""
+
+        for ircobj in [self.ircobj] + self.dcc_shards:
+            self.__IpToUser[ircobj] = {}
 
         self.__quitmsgs = []
         """A list of available quit messages used by the bot when quitting from a server."""
@@ -101,6 +117,9 @@ class mcxPyBot(SingleServerIRCBot):
         self.__commandHandlers = {}
         """Dict saving all command handlers."""
 
+        self.__databaseLock = Lock()
+        """Lock serializing the commands using the database, which are run by the DCC shards, too."""
+
         # mcxDatbase
         self.__database = dbcon
         """A reference to a mcxDatabase object."""
@@ -122,6 +141,7 @@ class mcxPyBot(SingleServerIRCBot):
         # add new command handlers here
         # query commands
         self.__addCommandHandler('die', 'query')
+        self.__addCommandHandler('getConnectionPoolStats', 'query')
 
         # channel commands
         self.__addCommandHandler('greet', 'channel')
@@ -134,6 +154,7 @@ class mcxPyBot(SingleServerIRCBot):
 
         # registered user commands
         self.__addCommandHandler('getLatestMessage', 'authed_dcc', True)
+        self.__addCommandHandler('getFile', 'authed_dcc')
 
         # admin commands
         # not implemented yet
@@ -239,6 +260,18 @@ class mcxPyBot(SingleServerIRCBot):
         """
         self.die(self.getRandomQuitMsg())
 
+    def cmd_query_getConnectionPoolStats(self, c, e):
+        """
+            send the statistics of the connection pooler
+
+            @type c: ServerConnection
+            @param c: connection object to the server
+
+            @type e: Event
+            @param e: event object that was fired
+        """
+        c.privmsg(nm_to_n(e.source()), DCC_CONNECTION_POOL_STATS % self.__connectionPool.stats())
+
     def cmd_not_authed_dcc_auth(self, c, e):
         """
             auth command, a user may authenticate itself by sending a authentification key
@@ -252,7 +285,7 @@ class mcxPyBot(SingleServerIRCBot):
         UserId = self.__authUser(c, e)
 
         if int(UserId) > 0:
-            self.__IpToUser[self.getIpStringByDCCConnection(c)]['auth'] = 'authed_dcc'
+            self.__getSessions(c)[self.getIpStringByDCCConnection(c)]['auth'] = 'authed_dcc'
             c.privmsg(AUTH_USER_SUCCESS_BY_BOTKEY)
         else:
             c.privmsg(AUTH_USER_FAILED)
@@ -277,6 +310,60 @@ class mcxPyBot(SingleServerIRCBot):
         else:
             c.privmsg(NO_LATEST_MESSAGE)
 
+    def cmd_authed_dcc_getFile(self, c, e):
+        """
+            send a file of the CONFIG_DCC_SEND_DIRECTORY to the user via DCC SEND
+
+            @type c: DCCConnection
+            @param c: connection object to the server
+
+            @type e: Event
+            @param e: event object that was fired
+        """
+        try:
+            filename = self.getParameterListByEvent(e)[0]
+        except IndexError:
+            filename = ''
+
+        # only files directly inside the directory may be requested
+        directory = realpath(CONFIG_DCC_SEND_DIRECTORY)
+        path = realpath(join(directory, filename))
+        if not filename or path != join(directory, filename) or not isfile(path):
+            c.privmsg(FILE_NOT_FOUND % filename)
+            return
+
+        nick = self.__getSessions(c)[self.getIpStringByDCCConnection(c)].get('nick')
+        if nick is None:
+            c.privmsg(FILE_TRANSFER_FAILED % filename)
+            return
+
+        # the transfer is offered via the server connection
+        self.ircobj.call_soon_threadsafe(self.__offerFile, (c, nick, path, filename))
+
+    def __offerFile(self, c, nick, path, filename):
+        """
+            offer a file via DCC SEND, runs in the bot's thread
+
+            @type c: DCCConnection
+            @param c: the dcc connection on which the user requested the file
+
+            @type nick: string
+            @param nick: nickname of the user
+
+            @type path: string
+            @param path: path of the file
+
+            @type filename: string
+            @param filename: name of the file requested by the user
+        """
+        try:
+            self.dcc_send(nick, path, CONFIG_DCC_SEND_RATE)
+            message = FILE_TRANSFER_OFFERED % filename
+        except (DCCConnectionError, ServerConnectionError), error:
+            message = FILE_TRANSFER_FAILED % filename
+            print 'DCC SEND of %s to %s failed: %s' % (path, nick, error)
+        c.irclibobj.call_soon_threadsafe(c.privmsg, (message,))
+
     #} end registered commands
 
     #{ event handlers
@@ -309,6 +396,8 @@ class mcxPyBot(SingleServerIRCBot):
         c.nick(self._nickname)
         c.privmsg('NICKSERV', 'IDENTIFY %s' % self.__password)
         c.join(self.channel)
+        # deliver updates found while disconnected
+        self.deliverUpdates()
 
     def on_privmsg(self, c, e):
         """
@@ -360,7 +449,7 @@ class mcxPyBot(SingleServerIRCBot):
     def on_dccchat(self, c, e):
         """
             commands executed when the bot received a request for a new dcc chat
-            currently does nothing
+            queues the connection to the user in the connection pooler
 
             @type c: ServerConnection
             @param c: connection object to the server
@@ -369,9 +458,6 @@ class mcxPyBot(SingleServerIRCBot):
             @param e: event object that was fired
         """
 
-        self.__privMsg(c, e, FEATURE_DISABLED)
-        return
-
         # check parameters
         if len(e.arguments()) != 2:
             return
@@ -385,39 +471,114 @@ class mcxPyBot(SingleServerIRCBot):
             except ValueError:
                 return
 
-            DCCQueue.append((address, port))
-            self.__privMsg(c, e, DCC_CONNECTION_QUEUED)
+            if self.__connectionPool.append(address, port, nm_to_n(e.source())):
+                self.__privMsg(c, e, DCC_CONNECTION_QUEUED)
+            else:
+                self.__privMsg(c, e, DCC_CONNECTION_QUEUE_FULL)
+
+    def dcc_connect(self, address, port, nick = None):
+        """
+            connect to a DCC chat offered by a user
+
+            @type address: string
+            @param address: IP address of the user
 
-            #try:
-            #    con = self.dcc_connect(address, port)
-            #    self.__IpToUser[self.getIpStringByDCCConnection(con)] = {"auth": NOT_AUTHED, "userid": 0}
-            #except DCCConnectionError, error:
-            #    print 'DCC Connection failed: %s:%s' % (address, port)
-            #    print error
+            @type port: number
+            @param port: port offered by the user
 
-    def dcc_connect(address, port):
+            @type nick: string
+            @param nick: nickname of the user, required for sending files to the user
+        """
         try:
-            con = SimpleIRCClient.dcc_connect(self, address, port)
-            self.__IpToUser[self.getIpStringByDCCConnection(con)] = {"auth": NOT_AUTHED, "userid": 0}
+            con = SingleServerIRCBot.dcc_connect(self, address, port)
+            self.__addDCCUser(con, nick)
             return con
 
         except DCCConnectionError, error:
             print 'DCC Connection failed: %s:%s' % (address, port)
             print error
 
-    def on_event(self, c, e):
+    def __dccConnected(self, sock, address, port, nick, error):
         """
-            method that's executed on every event
+            called by the connection pooler when a connection to a dcc chat is established or failed
 
-            @type c: ServerConnection
-            @param c: connection object to the server
+            @type sock: socket
+            @param sock: the connected socket, None on failure
 
-            @type e: Event
-            @param e: event object that was fired
+            @type address: string
+            @param address: IP address of the user
+
+            @type port: number
+            @param port: port offered by the user
+
+            @type nick: string
+            @param nick: nickname of the user
+
+            @type error: socket.error
+            @param error: the reason of a failure, None on success
         """
+        if sock is None:
+            print 'DCC Connection failed: %s:%s' % (address, port)
+            print error
+            try:
+                self.connection.privmsg(nick, DCC_CONNECTION_FAILED)
+            except ServerConnectionError:
+                # lost the server meanwhile, nobody to tell
+                pass
+            return
 
-        # any updates available?
-        if EVENT_MCX_UPDATES_AVAILABLE.isSet():
+        self.dcc_ircobj(address).call_soon_threadsafe(self.__dccAdopt, (sock, address, port, nick))
+
+    def __dccAdopt(self, sock, address, port, nick):
+        """
+            serve a connection established by the connection pooler, runs in the thread of the DCC shard serving address
+        """
+        self.__addDCCUser(self.dcc_adopt(sock, address, port), nick)
+
+    def __addDCCUser(self, c, nick):
+        """
+            remember the user on a new DCCConnection as not authed
+
+            @type c: DCCConnection
+            @param c: the new dcc connection
+
+            @type nick: string
+            @param nick: nickname of the user
+        """
+        self.__getSessions(c)[self.getIpStringByDCCConnection(c)] = {"auth": NOT_AUTHED, "userid": 0, "nick": nick}
+
+    def __getSessions(self, c):
+        """
+            returns the IP (dcc) to user relations of the DCC shard serving a connection
+
+            @type c: DCCConnection
+            @param c: a dcc connection
+
+            @rtype: dict
+            @return: dict of IP to user relations, only used by the thread of the shard
+        """
+        return self.__IpToUser[c.irclibobj]
+
+    #} end event handlers
+
+    #{ update handling
+
+    def notifyUpdates(self):
+        """
+            tells the bot that updates are available
+
+            @summary: This method may be called from any thread; the updates are delivered by the bot's thread.
+        """
+        self.ircobj.call_soon_threadsafe(self.deliverUpdates)
+
+    def deliverUpdates(self):
+        """
+            sends all available updates to the channel
+
+            @summary: Called via notifyUpdates by the update check thread, and after (re)connecting.
+        """
+        # any updates available and anyone to tell?
+        if EVENT_MCX_UPDATES_AVAILABLE.isSet() and self.connection.is_connected():
             # gather all updates
             availableUpdates = mcxUpdateThread.getUpdates()
             # for each update group
@@ -430,7 +591,7 @@ class mcxPyBot(SingleServerIRCBot):
             # after all reset event
             EVENT_MCX_UPDATES_AVAILABLE.clear()
 
-    #} end event handlers
+    #} end update handling
 
     #{ auth functions
 
@@ -449,7 +610,7 @@ class mcxPyBot(SingleServerIRCBot):
         """
         try:
             UserId = self.__database.getUserIdByBotKey(self.getParameterListByEvent(e)[0]);
-            self.__IpToUser[self.getIpStringByDCCConnection(c)]['userid'] = int(UserId)
+            self.__getSessions(c)[self.getIpStringByDCCConnection(c)]['userid'] = int(UserId)
             return UserId
         except IndexError:
             return 0;
@@ -465,7 +626,7 @@ class mcxPyBot(SingleServerIRCBot):
             @return: user id or NOT_AUTHED constant
         """
         try:
-            UserId = self.__IpToUser[self.getIpStringByDCCConnection(c)]['userid']
+            UserId = self.__getSessions(c)[self.getIpStringByDCCConnection(c)]['userid']
             if UserId > 0:
                 return UserId
             else:
@@ -532,7 +693,7 @@ class mcxPyBot(SingleServerIRCBot):
             @param e: event object that was fired
         """
         # get command type
-        cmdtype = self.__resolveCommandType(command, e)
+        cmdtype = self.__resolveCommandType(command, c, e)
 
         # ensure the cmd is valid
         if self.__commandExists(command, cmdtype):
@@ -548,6 +709,12 @@ class mcxPyBot(SingleServerIRCBot):
                         # tell the user
                         self.__privMsg(c, e, DATABASE_SERVER_NOT_AVAILABLE)
                     # otherwise execute command
+                    elif self.__commandHandlers[cmdtype][command]['db'] == True:
+                        self.__databaseLock.acquire()
+                        try:
+                            self.__commandHandlers[cmdtype][command]['func'](c, e)
+                        finally:
+                            self.__databaseLock.release()
                     else:
                         self.__commandHandlers[cmdtype][command]['func'](c, e)
                 # command not registered, tell the user
@@ -620,13 +787,16 @@ class mcxPyBot(SingleServerIRCBot):
         except KeyError:
             return False
 
-    def __resolveCommandType(self, command, e):
+    def __resolveCommandType(self, command, c, e):
         """
             resolves the command type by an event and a command
 
             @type command: string
             @param command: name of the command to execute
 
+            @type c: Connection
+            @param c: either DCCConnection or ServerConnection
+
             @type e: Event
             @param e: event object that was fired
 
@@ -635,7 +805,7 @@ class mcxPyBot(SingleServerIRCBot):
         """
         # check for existing DCC Connection
         try:
-            if self.__IpToUser[e.source()]['auth'] == NOT_AUTHED:
+            if self.__getSessions(c)[e.source()]['auth'] == NOT_AUTHED:
                 return 'not_authed_dcc'
             else:
                 return 'authed_dcc'
@@ -648,20 +818,23 @@ class mcxPyBot(SingleServerIRCBot):
                 # defaults to channel
                 return 'channel'
 
-    def __resolveCommandFunction(self, command, e):
+    def __resolveCommandFunction(self, command, c, e):
         """
             resolve the function to call by an event and a command
 
             @type command: string
             @param command: name of the command to execute
 
+            @type c: Connection
+            @param c: either DCCConnection or ServerConnection
+
             @type e: Event
             @param e: event object that was fired
 
             @rtype: string
             @return: actual name of the function to call
         """
-        return self.__getFullCommandName(command, self.__resolveCommandType(command, e))
+        return self.__getFullCommandName(command, self.__resolveCommandType(command, c, e))
 
     def __getFullCommandName(self, command, type):
         """
@@ -751,7 +924,17 @@ class mcxPyBot(SingleServerIRCBot):
     #{ message bridging handling 
     
     def messageBridgeInput(self, input):
-        self.connection.privmsg(self.channel, input)
+        """
+            sends a message received by the message bridge to the channel
+
+            @type input: string
+            @param input: the message to send
+        """
+        try:
+            self.connection.privmsg(self.channel, input)
+        except ServerConnectionError, error:
+            # not connected to the server (e.g. while reconnecting), so the message is dropped
+            print 'Message bridge dropped a message: %s' % error
 
     #} end message bridging handling functions
 
@@ -798,6 +981,10 @@ if __name__ == '__main__':
         # create mcxPyBot
         bot = mcxPyBot(channel, nickname, password, server, port, mcxDB)
 
+        # message bridging from megacomplex web application, served by the bot's event loop
+        # created before the bot thread runs the loop, which must be the only thread touching it
+        mcxMessageBridge(bot.ircobj, bot.messageBridgeInput)
+
         # start mcxPyBot
         mcxBotThread = mcxPyBotThread(bot)
         mcxBotThread.setName(THREAD_NAME_MCXPYBOT)
@@ -814,28 +1001,17 @@ if __name__ == '__main__':
             print "%s running .." % THREAD_NAME_RECOVERDB
 
         # create thread checking for updates on database
-        mcxUpdateThread = mcxCheckUpdatesThread(DATABASE_HOST, DATABASE_USER, DATABASE_PASS, DATABASE_NAME)
+        mcxUpdateThread = mcxCheckUpdatesThread(DATABASE_HOST, DATABASE_USER, DATABASE_PASS, DATABASE_NAME, bot.notifyUpdates)
         mcxUpdateThread.setName(THREAD_NAME_UPDATECHECK)
         mcxUpdateThread.setDaemon(True)
         mcxUpdateThread.start()
         if mcxUpdateThread.isAlive:
             print "%s running .." % THREAD_NAME_UPDATECHECK
             
-        # create thread for message bridging from megacomplex web application
-        mcxMessageThread = mcxMessageBridgeThread(bot.messageBridgeInput)
-        mcxMessageThread.setName(THREAD_NAME_MESSAGEBRIDGE)
-        mcxMessageThread.setDaemon(True)
-        mcxMessageThread.start()
-        if mcxMessageThread.isAlive:
-            print "%s running .." % THREAD_NAME_MESSAGEBRIDGE
-
-        # create thread for connection pooling
-        #mcxConnectionPool = mcxPyBotConnectionPooler()
-        #mcxConnectionPool.setName(THREAD_NAME_CONNECTIONPOOL)
-        #mcxConnectionPool.setDaemon(True)
-        #mcxConnectionPool.start()
-        #if mcxConnectionPool.isAlive:
-        #    print "%s running .." % THREAD_NAME_CONNECTIONPOOL
+        print "%s running .." % THREAD_NAME_MESSAGEBRIDGE
+
+        # threads for connection pooling are created by the bot
+        print "%s running .." % THREAD_NAME_CONNECTIONPOOL
 
         # wait for threads to terminate
         mcxBotThread.join()
@@ -11,48 +11,171 @@
 
 This module pools DCCConnection of mcxPyBot.
 
+Connecting to a DCC peer blocks until the peer answers or the connect times out. The pooler does this in a
+pool of worker threads and hands the connected sockets over to the thread running the bot, so a slow peer
+never stalls the bot's event loop.
+
 @author: Toni Uebernickel
 @organization: Whitestarprogramming GbR
 @copyright: 2008-2009 Whitestarprogramming GbR. All rights reserved.
 @contact: tuebernickel@whitestarprogramming.de
-
-@var DCCQueue: Queue.queue with tuple of (address, port) each entry.
 """
 
 # base libs
-from Queue import *
+from Queue import Full
+from Queue import Queue
+from threading import Lock
 from threading import Thread
+import socket
 
 # mcxPyBot imports
-from mcxPyBotConnectionPoolerConstants import CONFIG_AMOUNT_OF_THREADS
-
-DCCQueue = Queue.queue
+from irclib import monotonic
+from mcxPyBotConnectionPoolerConstants import *
+from mcxPyBotConstants import THREAD_NAME_CONNECTIONPOOL
 
 class mcxPyBotConnectionThread(Thread):
     """
         A thread that handles queued DCCConnection.
     """
 
+    def __init__(self, queue, connect):
+        """
+            @type queue: Queue
+            @param queue: the queue of connection requests, None ends the thread
+
+            @type connect: callable
+            @param connect: called with each connection request
+        """
+        Thread.__init__(self)
+        self.__queue = queue
+        self.__connect = connect
+
     def run(self):
-        pass
+        while True:
+            request = self.__queue.get()
+            if request is None:
+                break
+            self.__connect(*request)
 
-class mcxPyBotConnectionPooler():
+class mcxPyBotConnectionPooler:
     """
         A class pooling DCCConnection that are requested within mcxPyBot.
+
+        @summary: The callback is called from the thread running the IRC object (see irclib.IRC.call_soon_threadsafe)
+            with the connected socket (None on failure), the address, port and data given to append and the
+            socket.error (None on success).
     """
 
-    def __init__(self):
+    def __init__(self, ircobj, callBack, threads = AMOUNT_OF_THREADS, size = CONFIG_QUEUE_SIZE):
+        """
+            @type ircobj: irclib.IRC
+            @param ircobj: the IRC object the connected sockets are handed over to
+
+            @type callBack: callable
+            @param callBack: called with the result of each connection request
+
+            @type threads: number
+            @param threads: amount of worker threads
+
+            @type size: number
+            @param size: amount of connection requests waiting at most
+        """
+        self.__ircobj = ircobj
+        self.__callback = callBack
+
+        self.__queue = Queue(size)
+        """Queue of (address, port, data, time queued) connection requests."""
+
+        self.__lock = Lock()
+        self.__connected = 0
+        self.__failed = 0
+        self.__latency = 0.0
+        self.__maxLatency = 0.0
+        self.__wait = 0.0
+        self.__maxWait = 0.0
+
         self.threadPool = []
         """Pool (list) of threads that will be created and used by the ConnectionPooler"""
 
         # setup threads
         i = 0
-        while i < AMOUNT_OF_THREADS:
+        while i < threads:
             i = i + 1
 
             # start thread
-            connectionThread = mcxPyBotConnectionThread()
+            connectionThread = mcxPyBotConnectionThread(self.__queue, self.__connect)
+            connectionThread.setName("%s %d" % (THREAD_NAME_CONNECTIONPOOL, i))
             connectionThread.setDaemon(True)
             connectionThread.start()
 
-            self.threadPool.append(connectionThread)
\ No newline at end of file
+            self.threadPool.append(connectionThread)
+
+    def append(self, address, port, data = None):
+        """
+            queue a connection to a DCC peer
+
+            @type address: string
+            @param address: IP address of the peer
+
+            @type port: number
+            @param port: port of the peer
+
+            @param data: passed to the callback unchanged
+
+            @rtype: bool
+            @return: False if the queue is full
+        """
+        try:
+            self.__queue.put_nowait((address, port, data, monotonic()))
+            return True
+        except Full:
+            return False
+
+    def stats(self):
+        """
+            @rtype: dict
+            @return: queue depth, amount of connects and failures, average and maximum connect latency and
+                time waited in the queue (in seconds)
+        """
+        self.__lock.acquire()
+        try:
+            done = self.__connected + self.__failed
+            return {'queued': self.__queue.qsize(),
+                    'connected': self.__connected,
+                    'failed': self.__failed,
+                    'latency': done and self.__latency / done,
+                    'maxLatency': self.__maxLatency,
+                    'wait': done and self.__wait / done,
+                    'maxWait': self.__maxWait}
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        """Let the threads end after the queued connection requests."""
+        for thread in self.threadPool:
+            self.__queue.put(None)
+
+    def __connect(self, address, port, data, queued):
+        """Connect to a peer, runs in the worker threads."""
+        started = monotonic()
+        try:
+            sock = socket.create_connection((address, port), CONFIG_CONNECT_TIMEOUT)
+            error = None
+        except socket.error, (error):
+            sock = None
+        finished = monotonic()
+
+        self.__lock.acquire()
+        try:
+            if sock is None:
+                self.__failed = self.__failed + 1
+            else:
+                self.__connected = self.__connected + 1
+            self.__latency = self.__latency + finished - started
+            self.__maxLatency = max(self.__maxLatency, finished - started)
+            self.__wait = self.__wait + started - queued
+            self.__maxWait = max(self.__maxWait, started - queued)
+        finally:
+            self.__lock.release()
+
+        self.__ircobj.call_soon_threadsafe(self.__callback, (sock, address, port, data, error))
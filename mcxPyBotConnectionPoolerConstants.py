@@ -15,9 +15,20 @@
 @contact: tuebernickel@whitestarprogramming.de
 
 @var DCC_CONNECTION_QUEUED: Message sent to user, the DCCConnection was appended to the poolers queue.
+@var DCC_CONNECTION_QUEUE_FULL: Message sent to user, when the poolers queue is full.
+@var DCC_CONNECTION_FAILED: Message sent to user, when the DCCConnection could not be established.
+@var DCC_CONNECTION_POOL_STATS: Message sent to user containing the statistics of the connection pooler.
 @var AMOUNT_OF_THREADS: Amount of threads the connection pooler will create.
+@var CONFIG_QUEUE_SIZE: Amount of connection requests waiting in the poolers queue at most.
+@var CONFIG_CONNECT_TIMEOUT: Seconds to wait for a DCC peer to accept the connection.
 """
 
 DCC_CONNECTION_QUEUED = "Der Verbindungsaufbau wurde gestartet."
+DCC_CONNECTION_QUEUE_FULL = "Derzeit werden zu viele Verbindungen aufgebaut, bitte versuche es spaeter noch einmal."
+DCC_CONNECTION_FAILED = "Die Verbindung konnte nicht aufgebaut werden."
+DCC_CONNECTION_POOL_STATS = "Warteschlange: %(queued)d, verbunden: %(connected)d, fehlgeschlagen: %(failed)d, " \
+    "Verbindungsaufbau: %(latency).3fs (max. %(maxLatency).3fs), Wartezeit: %(wait).3fs (max. %(maxWait).3fs)"
 
-AMOUNT_OF_THREADS = 3
\ No newline at end of file
+AMOUNT_OF_THREADS = 3
+CONFIG_QUEUE_SIZE = 32
+CONFIG_CONNECT_TIMEOUT = 10
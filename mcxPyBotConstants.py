@@ -15,6 +15,14 @@
 @contact: tuebernickel@whitestarprogramming.de
 
 @var DATE_FORMAT_STRING: A date format string for the datetime module that will be used when sending datetime information to the user.
+@var CONFIG_FLOOD_LINES_PER_SECOND: Amount of lines per second sent to the IRC server at most (None for no limit).
+@var CONFIG_FLOOD_BYTES_PER_SECOND: Amount of bytes per second sent to the IRC server at most (None for no limit).
+@var CONFIG_FLOOD_BURST_LINES: Amount of lines that may be sent at once before the line limit applies.
+@var CONFIG_FLOOD_BURST_BYTES: Amount of bytes that may be sent at once before the byte limit applies.
+@var CONFIG_DCC_SHARDS: Amount of threads serving DCC chats, 0 serves them in the bot's thread.
+@var CONFIG_DCC_SEND_DIRECTORY: Directory containing the files users may request with getFile.
+@var CONFIG_DCC_SEND_RATE: Amount of bytes per second sent to a user per file transfer at most (None for no limit).
+@var CONFIG_DCC_SEND_MAX_TRANSFERS: Amount of file transfers running at the same time at most.
 
 @var CONFIG_DATABASE_NOT_AVAILABLE: Error message displayed when database is not available while configuration of mcxPyBot is running.
 @var CONFIG_COMMAND_EXEC_NOT_FOUND: Error message displayed when the required method for a configurated command is not found.
@@ -24,7 +32,7 @@
 @var THREAD_NAME_RECOVERDB: The name for the thread recovering mcxPersistent connection.
 @var THREAD_NAME_UPDATECHECK: The name for the thread which is checking for new available update.
 @var THREAD_NAME_CONNECTIONPOOL: The name for the thread which is pooling DCC connections.
-@var THREAD_NAME_MESSAGEBRIDGE: The name for the thread bridging messages..
+@var THREAD_NAME_MESSAGEBRIDGE: The name of the message bridge.
 
 @var INVALID_CONNECTION: Exception message for invalid connection on connection parameters.
 @var INVALID_BOT_OBJECT: Exception message for invalid mcxPyBot object reference.
@@ -45,10 +53,22 @@
 @var LATEST_MESSAGE_FROM: Message sent to user with sender name and date the message was sent.
 @var LATEST_MESSAGE_SUBJECT: Message sent to user containing the subject of the message.
 @var LATEST_MESSAGE_BODY: Message sent to user containing the content of the latest message.
+
+@var FILE_NOT_FOUND: Message sent to user, when a requested file is not available.
+@var FILE_TRANSFER_FAILED: Message sent to user, when a file transfer could not be started.
+@var FILE_TRANSFER_OFFERED: Message sent to user, when a file has been offered via DCC SEND.
 """
 
 # configuration
 DATE_FORMAT_STRING = '%H:%M:%S %d.%m.%Y'
+CONFIG_FLOOD_LINES_PER_SECOND = 1
+CONFIG_FLOOD_BYTES_PER_SECOND = 512
+CONFIG_FLOOD_BURST_LINES = 5
+CONFIG_FLOOD_BURST_BYTES = 2048
+CONFIG_DCC_SHARDS = 2
+CONFIG_DCC_SEND_DIRECTORY = 'files'
+CONFIG_DCC_SEND_RATE = 65536
+CONFIG_DCC_SEND_MAX_TRANSFERS = 4
 
 # failed configuration messages
 CONFIG_DATABASE_NOT_AVAILABLE = 'Database not available for command %s'
@@ -86,4 +106,9 @@ NO_LATEST_MESSAGE = 'Du hast keine Nachricht im Posteingang.'
 LATEST_MESSAGE_INTRO = 'Deine neueste Nachricht:'
 LATEST_MESSAGE_FROM = "Nachricht gesendet von %s (%s)"
 LATEST_MESSAGE_SUBJECT = "Betreff: %s"
-LATEST_MESSAGE_BODY = "Inhalt: %s"
\ No newline at end of file
+LATEST_MESSAGE_BODY = "Inhalt: %s"
+
+# file transfers
+FILE_NOT_FOUND = 'Die Datei wurde nicht gefunden: %s'
+FILE_TRANSFER_FAILED = 'Die Datei kann derzeit nicht gesendet werden: %s'
+FILE_TRANSFER_OFFERED = 'Die Datei %s wird dir gesendet.'
\ No newline at end of file
@@ -19,6 +19,7 @@
 from threading import Thread
 from datetime import datetime
 from time import sleep
+import errno
 import socket
 
 # mcxPyBot imports
@@ -143,11 +144,18 @@ class mcxCheckUpdatesThread(mcxDatabaseThread):
         @todo 0.7b: add reflection to __check() method
     """
 
-    def __init__(self, dbhost, dbuser, dbpass, dbname):
+    def __init__(self, dbhost, dbuser, dbpass, dbname, notify=None):
+        """
+            @type notify: callable
+            @param notify: called (from this thread) whenever EVENT_MCX_UPDATES_AVAILABLE gets fired
+        """
         # reset event
         if EVENT_MCX_UPDATES_AVAILABLE.isSet():
             EVENT_MCX_UPDATES_AVAILABLE.clear()
 
+        self.__notify = notify
+        """The callable informed about new updates."""
+
         self.__cursor = None
         """The cursor of MySQLdb library retrieved from the mcxPersistent object."""
 
@@ -274,6 +282,8 @@ class mcxCheckUpdatesThread(mcxDatabaseThread):
             if updatesAvailable:
                 # needs to be cleared by another thread
                 EVENT_MCX_UPDATES_AVAILABLE.set()
+                if self.__notify is not None:
+                    self.__notify()
 
     def __checkUpdateMessage(self):
         """
@@ -313,34 +323,91 @@ class mcxCheckUpdatesThread(mcxDatabaseThread):
         else:
             return False
 
-class mcxMessageBridgeThread(Thread):
+class mcxMessageBridge:
     """
-        A thread bridging messages received via socket connection to the IRC.
-        
+        Bridges messages received via socket connection to the IRC.
+
+        @summary: The bridge does not run a thread of its own. Its sockets are served by the event loop of the bot's IRC object,
+            so the callback is called from the same thread as all other event handlers of the bot.
+
         @todo 0.7b: authentication and authorization system
     """
-    def __init__(self, callBack):
-        self.__setupSocket()
+    def __init__(self, ircobj, callBack):
+        """
+            @type ircobj: irclib.IRC
+            @param ircobj: the IRC object whose loop serves the bridge
+
+            @type callBack: callable
+            @param callBack: called with each message (a string) received
+        """
+        self.__ircobj = ircobj
         self.__callback = callBack
-        Thread.__init__(self)
+        self.__clients = {}
+        """A dict of connected client sockets to their received data and timeout."""
+
+        self.__setupSocket()
+        self.__ircobj.add_reader(self.__socket, self.__accept)
 
     def __setupSocket(self):
         self.__host = ''
-        self.__port = 1338
+        self.__port = CONFIG_MESSAGEBRIDGE_PORT
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.__socket.bind((self.__host, self.__port))
-        self.__socket.listen(1)
-        
+        self.__socket.listen(5)
+        self.__socket.setblocking(0)
+
     def getSocket(self):
         return self.__socket
 
-    def run(self):
-        while self.isDaemon():
-            sock, addr = self.getSocket().accept()
-            socketFile = sock.makefile('rw', 0)
+    def close(self):
+        """Stop bridging and close all sockets."""
+        for sock in self.__clients.keys():
+            self.__close(sock)
+        self.__ircobj.remove_reader(self.__socket)
+        self.__socket.close()
 
-            self.__callback(socketFile.readline().strip())
+    def __accept(self):
+        """Accept a new client and wait for its message."""
+        try:
+            sock, addr = self.__socket.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        timeout = self.__ircobj.execute_delayed(CONFIG_MESSAGEBRIDGE_TIMEOUT, self.__close, (sock,))
+        self.__clients[sock] = ["", timeout]
+        self.__ircobj.add_reader(sock, self.__read, (sock,))
+
+    def __read(self, sock):
+        """
+            Read from a client until its message is complete.
 
-            socketFile.close()
-            sock.close()
\ No newline at end of file
+            @summary: A message ends with the first line break or when the client closes the connection.
+        """
+        try:
+            data = sock.recv(4096)
+        except socket.error, (error):
+            if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ""
+
+        client = self.__clients[sock]
+        client[0] = client[0] + data
+
+        if data and client[0].find("\n") == -1:
+            # wait for the rest of the message
+            return
+
+        message = client[0].split("\n", 1)[0].strip()
+        self.__close(sock)
+        if message:
+            self.__callback(message)
+
+    def __close(self, sock):
+        """Forget and close a client socket."""
+        client = self.__clients.pop(sock, None)
+        if client is None:
+            return
+        client[1].cancel()
+        self.__ircobj.remove_reader(sock)
+        sock.close()
@@ -15,6 +15,8 @@
 @contact: tuebernickel@whitestarprogramming.de
 
 @var CONFIG_CHECKUPDATE_INTERVAL: Amount of seconds the update check will wait between checks.
+@var CONFIG_MESSAGEBRIDGE_PORT: Port the message bridge is listening on.
+@var CONFIG_MESSAGEBRIDGE_TIMEOUT: Amount of seconds a client of the message bridge has to send its message.
 
 @var UPDATE_GROUP_UPDATEMESSAGE: Group ID of updateMessage
 @var UPDATE_MESSAGE_UPDATEMESSAGE: Message sent to the channel if a new updateMessage is available.
@@ -22,6 +24,8 @@
 
 # configuration
 CONFIG_CHECKUPDATE_INTERVAL = 15
+CONFIG_MESSAGEBRIDGE_PORT = 1338
+CONFIG_MESSAGEBRIDGE_TIMEOUT = 10
 
 # group configuration for all update events
 UPDATE_GROUP_UPDATEMESSAGE = 1
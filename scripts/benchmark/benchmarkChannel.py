@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+#  benchmarkChannel.py
+#  mcxPyBot
+#
+
+"""benchmarkChannel -- Memory and lookup cost of ircbot.Channel members.
+
+Compares the Channel of ircbot before members became flags (three
+IRCDicts of two dicts each) with the current one, for channels of 10k
+members sharing the same nicks.  10% of the members are operators and
+20% are voiced.
+
+Memory is the size of all objects reachable from the channels, except
+the nick strings which are shared with the caller.  The dictionary
+caching the lowercased nicks for the current IRCDict is reported
+separately, since all IRCDicts share it.
+
+It also times taking in the NAMES reply of such a channel, nick by
+nick as _on_namreply did before, and with Channel.add_names and
+end_names.
+
+Usage: benchmarkChannel.py [members] [channels]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import ircbot
+from irclib import irc_lower
+
+class LegacyIRCDict:
+    """IRCDict before the canonical keys were the only keys."""
+    def __init__(self):
+        self.data = {}
+        self.canon_keys = {}
+    def __setitem__(self, key, item):
+        if key in self:
+            del self[key]
+        self.data[key] = item
+        self.canon_keys[irc_lower(key)] = key
+    def __delitem__(self, key):
+        ck = irc_lower(key)
+        del self.data[self.canon_keys[ck]]
+        del self.canon_keys[ck]
+    def __contains__(self, key):
+        return irc_lower(key) in self.canon_keys
+
+class LegacyChannel:
+    """Channel before members became flags."""
+    def __init__(self):
+        self.userdict = LegacyIRCDict()
+        self.operdict = LegacyIRCDict()
+        self.voiceddict = LegacyIRCDict()
+        self.modes = {}
+    def add_user(self, nick):
+        self.userdict[nick] = 1
+    def set_mode(self, mode, value=None):
+        if mode == "o":
+            self.operdict[value] = 1
+        elif mode == "v":
+            self.voiceddict[value] = 1
+    def has_user(self, nick):
+        return nick in self.userdict
+    def is_oper(self, nick):
+        return nick in self.operdict
+
+def deep_size(roots, exclude):
+    """Bytes used by the objects reachable from roots, each counted
+    once, without the objects in exclude."""
+    seen = set(map(id, exclude))
+    size = 0
+    todo = list(roots)
+    while todo:
+        o = todo.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size = size + sys.getsizeof(o)
+        if isinstance(o, dict):
+            todo.extend(o.keys())
+            todo.extend(o.values())
+        elif isinstance(o, (list, tuple)):
+            todo.extend(o)
+        elif hasattr(o, "__dict__"):
+            todo.append(o.__dict__)
+    return size
+
+def fill(channel_class, nicks, count):
+    channels = []
+    for i in xrange(count):
+        ch = channel_class()
+        for n in xrange(len(nicks)):
+            nick = nicks[n]
+            if n % 10 == 0:
+                ch.set_mode("o", nick)
+            elif n % 5 == 1:
+                ch.set_mode("v", nick)
+            ch.add_user(nick)
+        channels.append(ch)
+    return channels
+
+def lookups(channels, nicks):
+    start = time.time()
+    for ch in channels:
+        for nick in nicks:
+            ch.has_user(nick)
+            ch.is_oper(nick)
+    return len(channels) * len(nicks) * 2 / (time.time() - start)
+
+def legacy_names(channel, names):
+    """The nick by nick loop of _on_namreply before add_names."""
+    for nick in names.split():
+        if nick[0] == "@":
+            nick = nick[1:]
+            channel.set_mode("o", nick)
+        elif nick[0] == "+":
+            nick = nick[1:]
+            channel.set_mode("v", nick)
+        channel.add_user(nick)
+
+def names_replies(nicks):
+    """The NAMES reply of a channel, in chunks of about 400 bytes."""
+    replies = []
+    chunk = []
+    length = 0
+    for n in xrange(len(nicks)):
+        name = nicks[n]
+        if n % 10 == 0:
+            name = "@" + name
+        elif n % 5 == 1:
+            name = "+" + name
+        chunk.append(name)
+        length = length + len(name) + 1
+        if length > 400:
+            replies.append(" ".join(chunk))
+            chunk = []
+            length = 0
+    if chunk:
+        replies.append(" ".join(chunk))
+    return replies
+
+def time_names(load, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        load()
+    return (time.time() - start) / rounds * 1000
+
+def main():
+    members = 10000
+    if len(sys.argv) > 1:
+        members = int(sys.argv[1])
+    count = 3
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+
+    rnd = random.Random(1459)
+    letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ[]`^_"
+    nicks = set()
+    while len(nicks) < members:
+        nicks.add("".join([rnd.choice(letters) for i in xrange(rnd.randint(4, 12))]))
+    nicks = list(nicks)
+
+    ircbot._canonical_keys.clear()
+    before = fill(LegacyChannel, nicks, count)
+    after = fill(ircbot.Channel, nicks, count)
+    before_size = deep_size(before, nicks)
+    after_size = deep_size(after, nicks)
+    # The lowercased nicks are counted with the channels already.
+    cache_size = sys.getsizeof(ircbot._canonical_keys)
+
+    print "%d channels of %d members" % (count, members)
+    print "before: %8.1f KiB per channel" % (before_size / 1024.0 / count)
+    print "after:  %8.1f KiB per channel (%.0f%%), plus %.1f KiB shared key cache" % (
+        after_size / 1024.0 / count, 100.0 * after_size / before_size, cache_size / 1024.0)
+    print "before: %10.0f lookups/sec" % lookups(before, nicks)
+    print "after:  %10.0f lookups/sec" % lookups(after, nicks)
+
+    replies = names_replies(nicks)
+    prefixes = {"@": "o", "+": "v"}
+    def load_before():
+        ch = LegacyChannel()
+        for reply in replies:
+            legacy_names(ch, reply)
+    def load_after():
+        ch = ircbot.Channel()
+        for reply in replies:
+            ch.add_names(reply, prefixes)
+        ch.end_names()
+    print "NAMES of %d members in %d replies:" % (members, len(replies))
+    print "before: %8.1f ms" % time_names(load_before, 10)
+    print "after:  %8.1f ms" % time_names(load_after, 10)
+
+if __name__ == "__main__":
+    main()
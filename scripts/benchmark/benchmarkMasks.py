@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+#  benchmarkMasks.py
+#  mcxPyBot
+#
+
+"""benchmarkMasks -- Hostmask lookups per second against a large mask list.
+
+Compares testing a hostmask against every mask of a list, with the
+mask_matches irclib had before (one re.compile per mask and call) and
+with the cached mask_matches, to a single lookup in irclib.MaskSet.
+
+The generated list mixes the usual kinds of ban and ignore masks:
+nick!*@*, *!*@host, *!user@*.domain, *!*@*.domain and masks without
+wildcards.
+
+Usage: benchmarkMasks.py [masks] [lookups]
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import irclib
+
+def legacy_mask_matches(nick, mask):
+    """mask_matches before compiled masks were cached."""
+    nick = irclib.irc_lower(nick)
+    mask = irclib.irc_lower(mask)
+    mask = mask.replace("\\", "\\\\")
+    for ch in ".$|[](){}+":
+        mask = mask.replace(ch, "\\" + ch)
+    mask = mask.replace("?", ".")
+    mask = mask.replace("*", ".*")
+    r = re.compile(mask, re.IGNORECASE)
+    return r.match(nick)
+
+def word(rnd, length):
+    return "".join([rnd.choice("abcdefghijklmnopqrstuvwxyz") for i in xrange(length)])
+
+def hostmask(rnd):
+    return "%s!%s@%s.%s.%s" % (word(rnd, rnd.randint(3, 9)), word(rnd, rnd.randint(3, 8)),
+                               word(rnd, rnd.randint(3, 8)), word(rnd, rnd.randint(3, 8)),
+                               rnd.choice(["com", "net", "org", "de"]))
+
+def make_masks(rnd, count):
+    masks = []
+    for i in xrange(count):
+        nick, rest = hostmask(rnd).split("!", 1)
+        user, host = rest.split("@", 1)
+        kind = i % 5
+        if kind == 0:
+            masks.append("%s!*@*" % nick)
+        elif kind == 1:
+            masks.append("*!*@%s" % host)
+        elif kind == 2:
+            masks.append("*!%s@*.%s" % (user, host.split(".", 1)[1]))
+        elif kind == 3:
+            masks.append("*!*@*.%s" % host.split(".", 1)[1])
+        else:
+            masks.append("%s!%s@%s" % (nick, user, host))
+    return masks
+
+def measure(lookup, nicks):
+    start = time.time()
+    for nick in nicks:
+        lookup(nick)
+    return len(nicks) / (time.time() - start)
+
+def main():
+    count = 10000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    lookups = 2000
+    if len(sys.argv) > 2:
+        lookups = int(sys.argv[2])
+
+    rnd = random.Random(1459)
+    masks = make_masks(rnd, count)
+    # Half of the hostmasks are banned by one of the masks.
+    nicks = [hostmask(rnd) for i in xrange(lookups)]
+    for i in xrange(0, lookups, 2):
+        mask = masks[rnd.randrange(count)]
+        nicks[i] = mask.replace("*!", "someone!").replace("!*@", "!someone@").replace("@*.", "@some.")
+
+    maskset = irclib.MaskSet(masks)
+    for nick in nicks[:50]:
+        expected = [m for m in masks if irclib.mask_matches(nick, m)]
+        if sorted(expected) != sorted(maskset.matches(nick)):
+            print "warning: MaskSet differs from mask_matches for %r" % nick
+
+    # Linear scans are slow, a few lookups are enough.
+    few = nicks[:max(1, lookups / 200)]
+    before = measure(lambda n: [m for m in masks if legacy_mask_matches(n, m)], few)
+    cached = measure(lambda n: [m for m in masks if irclib.mask_matches(n, m)], few)
+    after = measure(maskset.match, nicks)
+    print "%d masks, lookups of one hostmask against all of them" % count
+    print "legacy mask_matches: %10.1f lookups/sec" % before
+    print "cached mask_matches: %10.1f lookups/sec (%.1fx)" % (cached, cached / before)
+    print "MaskSet.match:       %10.1f lookups/sec (%.0fx)" % (after, after / before)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+#  benchmarkParser.py
+#  mcxPyBot
+#
+
+"""benchmarkParser -- Lines per second of the RFC 1459 message parser.
+
+Compares the regex based parsing ServerConnection.process_data used
+to do with irclib.parse_message.
+
+The corpus is a file with one raw IRC line per line.  The output of
+irclib with DEBUG = 1 can be used directly, the "FROM SERVER: " prefix
+is stripped and other debug output is skipped.  Without a corpus a
+small built-in sample of typical server traffic is used.
+
+Usage: benchmarkParser.py [corpus] [rounds]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import irclib
+
+SAMPLE = [
+    ":irc.example.net 001 mcxPyBot :Welcome to the Example IRC Network mcxPyBot!bot@example.org",
+    ":irc.example.net 005 mcxPyBot CHANTYPES=# PREFIX=(ov)@+ NETWORK=Example :are supported by this server",
+    ":irc.example.net 353 mcxPyBot = #megacomplex :@mcxPyBot +alice bob carol dave eve mallory trent",
+    ":irc.example.net 366 mcxPyBot #megacomplex :End of /NAMES list.",
+    ":irc.example.net 372 mcxPyBot :- Please respect the network rules.",
+    "PING :irc.example.net",
+    ":alice!alice@host-1.example.org PRIVMSG #megacomplex :hi everybody, anyone seen the new update?",
+    ":bob!~bob@10.0.0.2 PRIVMSG #megacomplex :mcxPyBot, greet",
+    ":carol!carol@users.example.org PRIVMSG mcxPyBot :\001VERSION\001",
+    ":dave!dave@host-4.example.org JOIN #megacomplex",
+    ":eve!eve@host-5.example.org PART #megacomplex :bye",
+    ":mallory!m@evil.example.org QUIT :irc.example.net hub.example.net",
+    ":alice!alice@host-1.example.org NICK :alice_away",
+    ":ChanServ!services@services.example.net MODE #megacomplex +o alice",
+    ":NickServ!services@services.example.net NOTICE mcxPyBot :You are now identified.",
+    ":trent!t@host-6.example.org TOPIC #megacomplex :Megacomplex - news and updates",
+]
+
+_rfc_1459_command_regexp = re.compile("^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
+
+def legacy_parse(line):
+    """The parsing done by ServerConnection.process_data before
+    irclib.parse_message existed."""
+    prefix = None
+    command = None
+    arguments = None
+    m = _rfc_1459_command_regexp.match(line)
+    if m.group("prefix"):
+        prefix = m.group("prefix")
+    if m.group("command"):
+        command = m.group("command").lower()
+    if m.group("argument"):
+        a = m.group("argument").split(" :", 1)
+        arguments = a[0].split()
+        if len(a) == 2:
+            arguments.append(a[1])
+    if command in irclib.numeric_events:
+        command = irclib.numeric_events[command]
+    return prefix, command, arguments
+
+def load_corpus(path):
+    lines = []
+    for line in open(path):
+        line = line.rstrip("\r\n")
+        if line.startswith("FROM SERVER: "):
+            line = line[len("FROM SERVER: "):]
+        elif line.startswith(("TO SERVER:", "command: ", "FROM PEER:", "TO PEER:")):
+            continue
+        if line and line[0] != " ":
+            lines.append(line)
+    return lines
+
+def measure(parse, lines, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        for line in lines:
+            parse(line)
+    return len(lines) * rounds / (time.time() - start)
+
+def main():
+    if len(sys.argv) > 1:
+        lines = load_corpus(sys.argv[1])
+    else:
+        lines = SAMPLE * 64
+    rounds = 20
+    if len(sys.argv) > 2:
+        rounds = int(sys.argv[2])
+
+    mismatches = [l for l in lines if legacy_parse(l) != irclib.parse_message(l)]
+    if mismatches:
+        print "warning: %d lines parse differently, e.g. %r" % (len(mismatches), mismatches[0])
+
+    before = measure(legacy_parse, lines, rounds)
+    after = measure(irclib.parse_message, lines, rounds)
+    print "%d lines x %d rounds" % (len(lines), rounds)
+    print "regex parser:  %10.0f lines/sec" % before
+    print "parse_message: %10.0f lines/sec (%.2fx)" % (after, after / before)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+#  benchmarkReactor.py
+#  mcxPyBot
+#
+
+"""benchmarkReactor -- Tick cost of IRC.process_once with idle connections.
+
+Compares the old process_once (rebuilding the socket list from all
+connections and calling select on every tick) with the reactor
+backends of irclib at 10, 1k and 10k idle connections.
+
+Usage: benchmarkReactor.py [ticks]
+"""
+
+import os
+import select
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import irclib
+
+SIZES = [10, 1000, 10000]
+FD_SETSIZE = 1024
+
+class IdleConnection:
+    """Minimal stand-in for a Connection holding an idle socket."""
+    def __init__(self, sock):
+        self.socket = sock
+
+    def _get_socket(self):
+        return self.socket
+
+def raise_fd_limit(wanted):
+    """Try to raise RLIMIT_NOFILE, returns the usable soft limit."""
+    try:
+        import resource
+    except ImportError:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            soft = wanted
+        except (ValueError, resource.error):
+            pass
+    return soft
+
+def legacy_tick(connections):
+    """The process_once body before the reactor backends existed."""
+    sockets = map(lambda x: x._get_socket(), connections)
+    sockets = filter(lambda x: x != None, sockets)
+    if sockets:
+        (i, o, e) = select.select(sockets, [], [], 0)
+
+def measure(tick, ticks):
+    start = time.time()
+    for i in xrange(ticks):
+        tick()
+    return (time.time() - start) / ticks * 1e6
+
+def main():
+    ticks = 200
+    if len(sys.argv) > 1:
+        ticks = int(sys.argv[1])
+
+    limit = raise_fd_limit(max(SIZES) + 64)
+    backends = [("select", irclib.SelectReactor)]
+    if hasattr(select, "poll"):
+        backends.append(("poll", irclib.PollReactor))
+    if hasattr(select, "epoll"):
+        backends.append(("epoll", irclib.EpollReactor))
+
+    print "usec per tick, %d ticks, idle connections" % ticks
+    print "%8s%12s" % ("conns", "legacy") + "".join(["%12s" % name for name, cls in backends])
+
+    for size in SIZES:
+        if size + 16 > limit:
+            print "%8d  skipped (RLIMIT_NOFILE is %d)" % (size, limit)
+            continue
+
+        # Unbound UDP sockets never become readable and only cost one
+        # descriptor each.
+        sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in xrange(size)]
+        connections = [IdleConnection(s) for s in sockets]
+        highest = max([s.fileno() for s in sockets])
+
+        row = "%8d" % size
+        if highest < FD_SETSIZE:
+            row = row + "%12.1f" % measure(lambda: legacy_tick(connections), ticks)
+        else:
+            row = row + "%12s" % "n/a"
+
+        for name, cls in backends:
+            if cls is irclib.SelectReactor and highest >= FD_SETSIZE:
+                row = row + "%12s" % "n/a"
+                continue
+            ircobj = irclib.IRC(reactor=cls())
+            for c in connections:
+                ircobj.fn_to_add_socket(c._get_socket())
+            row = row + "%12.1f" % measure(lambda: ircobj.process_once(0), ticks)
+
+        print row
+
+        for s in sockets:
+            s.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+#  checkDccSend.py
+#  mcxPyBot
+#
+
+"""checkDccSend -- Loopback check of DCCSendConnection transfers.
+
+Sends a file of random data to a receiver thread over the loopback
+interface and checks what arrived: a full transfer, a resumed one
+(acknowledged with the total and with the relative byte count), a
+rate-limited one, and an offer nobody accepts within accept_timeout.
+Prints the time each transfer took; exits non-zero if a check failed.
+
+Usage: checkDccSend.py [megabytes]
+"""
+
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import irclib
+
+def receive(address, port, received, start=0, relative=0):
+    """Receive a transfer, acknowledging each read like DCC clients do.
+
+    Acknowledgements are sent in two halves to check that the sender
+    puts split counters back together.
+    """
+    sock = socket.create_connection((address, port))
+    total = start
+    data = []
+    while 1:
+        chunk = sock.recv(2**16)
+        if not chunk:
+            break
+        data.append(chunk)
+        total = total + len(chunk)
+        if relative:
+            ack = struct.pack("!I", (total - start) & 0xffffffff)
+        else:
+            ack = struct.pack("!I", total & 0xffffffff)
+        sock.sendall(ack[:2])
+        sock.sendall(ack[2:])
+    sock.close()
+    received.append("".join(data))
+
+def transfer(path, rate=None, resume=0, relative=0):
+    """Send path to a receiver thread.
+
+    Returns a tuple of the dcc_disconnect events, the received data
+    and the seconds the transfer took.
+    """
+    ircobj = irclib.IRC()
+    events = []
+    ircobj.add_global_handler("dcc_disconnect",
+                              lambda c, e: events.append((c.complete, e.arguments()[0])))
+    dcc = ircobj.dcc_send(path, rate)
+    dcc.listen()
+    if resume and not dcc.resume(resume):
+        return events, "", 0.0
+    received = []
+    receiver = threading.Thread(target=receive,
+                                args=(dcc.localaddress, dcc.localport, received, resume, relative))
+    receiver.start()
+    start = time.time()
+    while not events and time.time() - start < 120:
+        ircobj.process_once(0.2)
+    elapsed = time.time() - start
+    receiver.join(10)
+    return events, "".join(received), elapsed
+
+def main():
+    megabytes = 4
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    size = megabytes * 2**20
+
+    fd, path = tempfile.mkstemp(prefix="checkDccSend")
+    os.write(fd, os.urandom(size))
+    os.close(fd)
+    content = open(path, "rb").read()
+    failures = 0
+
+    try:
+        rate = size / 2
+        cases = [("full", {}, 0),
+                 ("resumed", {"resume": size / 3}, 0),
+                 ("resumed, relative acks", {"resume": size / 3, "relative": 1}, 0),
+                 ("rate-limited", {"rate": rate}, float(size) / rate * 0.8)]
+        for name, arguments, least in cases:
+            events, data, elapsed = transfer(path, **arguments)
+            ok = len(events) == 1 and events[0][0] == 1 \
+                 and data == content[arguments.get("resume", 0):] \
+                 and elapsed >= least
+            if not ok:
+                failures = failures + 1
+            print "%-24s%-6s%8.2fs %8.1f MB/s" % (
+                name, ok and "ok" or "FAIL", elapsed,
+                len(data) / max(elapsed, 1e-6) / 2**20)
+
+        # Nobody connects, so the offer is closed after accept_timeout.
+        ircobj = irclib.IRC()
+        events = []
+        ircobj.add_global_handler("dcc_disconnect",
+                                  lambda c, e: events.append((c.complete, e.arguments()[0])))
+        dcc = ircobj.dcc_send(path)
+        dcc.accept_timeout = 0.5
+        dcc.listen()
+        start = time.time()
+        while not events and time.time() - start < 5:
+            ircobj.process_once(0.1)
+        elapsed = time.time() - start
+        ok = len(events) == 1 and events[0][0] == 0 \
+             and 0.5 <= elapsed < 5 and not ircobj.connections
+        if not ok:
+            failures = failures + 1
+        print "%-24s%-6s%8.2fs" % ("accept timeout", ok and "ok" or "FAIL", elapsed)
+    finally:
+        os.remove(path)
+
+    if failures:
+        print "%d check(s) failed" % failures
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+#  checkNetsplit.py
+#  mcxPyBot
+#
+
+"""checkNetsplit -- Check of the netsplit and netjoin batching of ircbot.
+
+Feeds QUITs and JOINs to a SingleServerIRCBot that is not connected
+and checks the channels, user_channels and the "netsplit" and
+"netjoin" events: a plain split, the users joining again after it, a
+user joining again while the split is still being batched, and a QUIT
+that isn't a netsplit.  Also times a split of many users.  Exits
+non-zero if a check failed.
+
+Usage: checkNetsplit.py [users]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import ircbot
+from irclib import Event
+
+SPLIT = "hub.example.net leaf.example.net"
+
+class Bot(ircbot.SingleServerIRCBot):
+    """A bot recording its netsplit and netjoin events."""
+    netsplit_delay = 0.1
+
+    def __init__(self, nicks, channels):
+        ircbot.SingleServerIRCBot.__init__(self, [("irc.example.net", 6667)], "bot", "bot")
+        # What connect would have set up.
+        self.connection.real_nickname = "bot"
+        self.connection.handlers = {}
+        self.events = []
+        for channel in channels:
+            self.receive("join", "bot", channel)
+            for nick in nicks:
+                self.receive("join", nick, channel)
+
+    def on_netsplit(self, c, e):
+        self.events.append(("netsplit", e.arguments()))
+
+    def on_netjoin(self, c, e):
+        self.events.append(("netjoin", e.arguments()))
+
+    def on_quit(self, c, e):
+        self.events.append(("quit", [e.source()]))
+
+    def receive(self, command, nick, target, arguments=[]):
+        self.ircobj._handle_event(self.connection,
+                                  Event(command, nick + "!user@host", target, arguments))
+
+    def settle(self):
+        """Run the loop until the batches are done."""
+        end = time.time() + self.netsplit_delay * 3
+        while time.time() < end:
+            self.ircobj.process_once(0.02)
+
+    def member(self, nick, channel):
+        return self.channels[channel].has_user(nick) \
+               and channel in self.user_channels.get(nick, ())
+
+def check(name, ok):
+    print "%-32s%s" % (name, ok and "ok" or "FAIL")
+    return ok
+
+def main():
+    users = 5000
+    if len(sys.argv) > 1:
+        users = int(sys.argv[1])
+    checks = []
+
+    bot = Bot(["alice", "bob", "carol"], ["#x", "#y"])
+    bot.receive("quit", "alice", None, [SPLIT])
+    bot.receive("quit", "bob", None, [SPLIT])
+    held = bot.member("alice", "#x") and not bot.events
+    bot.settle()
+    checks.append(check("netsplit", held
+                        and bot.events == [("netsplit", ["alice", "bob"])]
+                        and not bot.member("alice", "#x")
+                        and not bot.member("bob", "#y")
+                        and bot.member("carol", "#x")))
+
+    bot.events = []
+    bot.receive("join", "alice", "#x")
+    bot.receive("join", "bob", "#y")
+    bot.settle()
+    checks.append(check("netjoin", bot.events == [("netjoin", ["alice", "bob"])]
+                        and bot.member("alice", "#x")
+                        and not bot.member("alice", "#y")
+                        and bot.member("bob", "#y")))
+
+    # Rejoining within netsplit_delay, before the split was reported.
+    bot = Bot(["dave", "erin"], ["#x", "#y"])
+    bot.receive("quit", "dave", None, [SPLIT])
+    bot.receive("quit", "erin", None, [SPLIT])
+    bot.receive("join", "dave", "#x")
+    bot.settle()
+    checks.append(check("join during pending netsplit",
+                        bot.events == [("netsplit", ["erin"])]
+                        and bot.member("dave", "#x")
+                        and not bot.member("dave", "#y")
+                        and not bot.member("erin", "#x")))
+
+    bot = Bot(["frank"], ["#x"])
+    bot.receive("quit", "frank", None, ["Leaving"])
+    checks.append(check("plain quit", bot.events == [("quit", ["frank!user@host"])]
+                        and not bot.member("frank", "#x")))
+
+    nicks = ["user%d" % i for i in xrange(users)]
+    bot = Bot(nicks, ["#x", "#y"])
+    start = time.time()
+    for nick in nicks:
+        bot.receive("quit", nick, None, [SPLIT])
+    bot.settle()
+    elapsed = time.time() - start - bot.netsplit_delay * 3
+    checks.append(check("netsplit of %d users" % users,
+                        bot.events == [("netsplit", nicks)]
+                        and bot.channels["#x"].users() == ["bot"]))
+    print "%d QUITs batched in %.3fs" % (users, elapsed)
+
+    if not reduce(lambda a, b: a and b, checks):
+        print "%d check(s) failed" % checks.count(0)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()